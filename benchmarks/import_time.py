@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+measure how long it takes to import pipe1 (and some of its submodules)
+in a fresh interpreter, which is what every worker process and CLI run pays
+"""
+
+import sys
+import subprocess as sp
+from time import perf_counter
+from argparse import ArgumentParser
+
+TARGETS = [
+    'pipe1',
+    'pipe1.download_control',
+    'pipe1.dedup',
+    'pipe1.post_filtering',
+    'pipe1.downloading',
+    'pipe1.query_processing',
+    'pipe1.show_tiles'
+]
+
+def import_time(stmt,repeat = 5):
+    """ best wall-clock time (in seconds) of running `stmt` in a new interpreter """
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = perf_counter()
+        sp.run([sys.executable,'-c',stmt],check = True)
+        best = min(best,perf_counter() - t0)
+    return best
+
+
+if __name__ == '__main__':
+
+    ap = ArgumentParser(description = "time imports of pipe1 modules")
+    ap.add_argument(
+        "--repeat","-r",type = int,default = 5,
+        help = "number of runs per module (the best one is reported)"
+    )
+    ap.add_argument(
+        "modules",nargs = '*',default = TARGETS,
+        help = "modules to import (default: a selection of pipe1 modules)"
+    )
+    argz = vars(ap.parse_args())
+
+    base = import_time('pass',argz['repeat'])
+    print(f"{'interpreter startup':<28}{1000 * base:8.1f} ms")
+    for mod in argz['modules']:
+        t = import_time(f'import {mod}',argz['repeat']) - base
+        print(f"{mod:<28}{1000 * t:8.1f} ms")
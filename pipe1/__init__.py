@@ -1,15 +1,45 @@
-# functions exported at top level for convenience
-from .query_helpers import run_ql_query
-from .downloading import save_tiles, basic_tileset, shapely_tileset
-from .post_filtering import filter_size, filter_entropy, apply_filter
-from .query_processing import process_query
-from .utils import save_tsv, sample_complement
-from .show_tiles import plot_tiles
-
-__all__ = [
-    'run_ql_query','save_tiles','basic_tileset','shapely_tileset',
-    'filter_size','filter_entropy','apply_filter','process_query',
-    'save_tsv','sample_complement','plot_tiles'
-]
-
-__version__ = "0.0.2" # does not get exported into package namespace by setup.py
\ No newline at end of file
+# functions exported at top level for convenience
+# submodules (and their heavy dependencies: pandas, shapely, matplotlib, ...)
+# are only imported when one of their names is first used, so that
+# `import pipe1` stays cheap for worker processes and command line tools
+import importlib
+
+# public name -> submodule where it is defined
+_exports = {
+    'run_ql_query': 'query_helpers',
+    'save_tiles': 'downloading', 'basic_tileset': 'downloading', 'shapely_tileset': 'downloading',
+    'filter_size': 'post_filtering', 'filter_entropy': 'post_filtering', 'apply_filter': 'post_filtering',
+    'process_query': 'query_processing',
+    'save_tsv': 'utils', 'sample_complement': 'utils', 'sample_pyramid': 'utils',
+    'plot_tiles': 'show_tiles',
+    'save_processed': 'storage', 'load_processed': 'storage',
+    'save_tileset': 'storage', 'load_tileset': 'storage',
+    'update_processed': 'incremental', 'apply_delta': 'incremental',
+    'build_overviews': 'overviews',
+    'tile_mosaics': 'mosaics',
+    'DownloadController': 'download_control',
+    'DedupIndex': 'dedup', 'dedup_dir': 'dedup', 'hash_stats': 'dedup', 'update_manifest': 'dedup',
+    'plan_shards': 'sharding', 'write_shard_manifests': 'sharding',
+    'run_shard': 'sharding', 'merge_shards': 'sharding',
+    'tile_masks': 'masks',
+    'TileCatalog': 'catalog'
+}
+
+_submodules = set(_exports.values())
+
+__all__ = list(_exports)
+
+def __getattr__(name):
+    if name in _exports:
+        obj = getattr(importlib.import_module('.' + _exports[name],__name__),name)
+    elif name in _submodules:
+        obj = importlib.import_module('.' + name,__name__)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = obj # so __getattr__ isn't called again
+    return obj
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | _submodules)
+
+__version__ = "0.0.2" # does not get exported into package namespace by setup.py
@@ -0,0 +1,200 @@
+# a catalogue of downloaded tiles across datasets, kept in SQLite so subsets
+# (by area, zoom, tag, overlap or filter status) can be selected without
+# re-reading tile_info.tsv files or listing tile directories
+
+import os
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from .utils import tile_bounds
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    id INTEGER PRIMARY KEY,
+    file_loc TEXT NOT NULL UNIQUE,
+    dir TEXT NOT NULL,
+    dataset TEXT,
+    z INTEGER NOT NULL, x INTEGER NOT NULL, y INTEGER NOT NULL,
+    min_lat REAL, min_lon REAL, max_lat REAL, max_lon REAL,
+    entity TEXT, overlap REAL, tags TEXT, placename TEXT,
+    size INTEGER,
+    status TEXT NOT NULL DEFAULT 'ok'
+);
+CREATE INDEX IF NOT EXISTS tiles_zxy ON tiles (z,x,y);
+CREATE INDEX IF NOT EXISTS tiles_dataset ON tiles (dataset,status);
+CREATE INDEX IF NOT EXISTS tiles_dir ON tiles (dir,status);
+"""
+RTREE = "CREATE VIRTUAL TABLE IF NOT EXISTS tile_bounds USING rtree(id,min_lat,max_lat,min_lon,max_lon)"
+
+# optional columns of a tile table that are stored in the catalogue
+META_COLUMNS = ['entity','overlap','tags','placename']
+
+class TileCatalog:
+    """
+    SQLite catalogue of downloaded tiles. `save_tiles` and `apply_filter` keep it
+    up to date when given one; tile bounds go in an R-tree (if the SQLite build has
+    the module; otherwise area queries scan the bounds columns) and the attributes
+    are indexed, so `query` answers in milliseconds however many datasets there are.
+    Args:
+        path: the database file (created if needed), or ':memory:'
+    """
+    def __init__(self,path):
+        self.path = path
+        self.con = sqlite3.connect(os.path.expanduser(path) if path != ':memory:' else path)
+        self.con.executescript(SCHEMA)
+        try:
+            self.con.execute(RTREE)
+            self.rtree = True
+        except sqlite3.OperationalError: # SQLite built without the R-tree module
+            self.rtree = False
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def add(self,df,dataset = None,sizes = True):
+        """
+        Add (or update) tiles
+        Args:
+            df: DataFrame with columns x, y, z and file_loc (e.g. the output of `save_tiles`),
+            and optionally entity, overlap, tags and placename
+            dataset: optional, name of the dataset (e.g. 'positive'); defaults to
+            the `dataset` column of `df`, if there is one
+            sizes: whether to record the file sizes (one `stat` per file)
+        Returns: number of tiles added
+        """
+        if any(e not in df.columns for e in ('x','y','z','file_loc')):
+            raise ValueError("df must have columns x, y, z and file_loc")
+        if not df.shape[0]:
+            return 0
+        flocs = [os.path.abspath(f) for f in df['file_loc']]
+        bb = tile_bounds(df['x'].values,df['y'].values,df['z'].values)
+        if dataset is None and 'dataset' in df.columns:
+            ds = df['dataset'].astype(str).tolist()
+        else:
+            ds = [dataset] * df.shape[0]
+        meta = [df[c].tolist() if c in df.columns else [None] * df.shape[0] for c in META_COLUMNS]
+        meta[0] = [None if e is None else str(e) for e in meta[0]]
+        meta[2] = [e if e is None or isinstance(e,str) else json.dumps(e) for e in meta[2]]
+        size = [os.path.getsize(f) if os.path.exists(f) else None for f in flocs] if sizes \
+            else [None] * len(flocs)
+        rows = zip(flocs,[os.path.dirname(f) for f in flocs],ds,
+            df['z'].astype(int).tolist(),df['x'].astype(int).tolist(),df['y'].astype(int).tolist(),
+            *(b.tolist() for b in bb),*meta,size)
+        with self.con:
+            self.con.execute("CREATE TEMP TABLE IF NOT EXISTS new_locs (file_loc TEXT PRIMARY KEY)")
+            self.con.execute("DELETE FROM new_locs")
+            self.con.executemany("""
+                INSERT INTO tiles (file_loc,dir,dataset,z,x,y,min_lat,min_lon,max_lat,max_lon,
+                    entity,overlap,tags,placename,size,status)
+                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,'ok')
+                ON CONFLICT (file_loc) DO UPDATE SET
+                    dataset = excluded.dataset,z = excluded.z,x = excluded.x,y = excluded.y,
+                    min_lat = excluded.min_lat,min_lon = excluded.min_lon,
+                    max_lat = excluded.max_lat,max_lon = excluded.max_lon,
+                    entity = excluded.entity,overlap = excluded.overlap,tags = excluded.tags,
+                    placename = excluded.placename,size = excluded.size,status = 'ok'
+            """,rows)
+            if self.rtree:
+                self.con.executemany("INSERT OR IGNORE INTO new_locs VALUES (?)",((f,) for f in flocs))
+                self.con.execute("""
+                    INSERT OR REPLACE INTO tile_bounds
+                    SELECT t.id,t.min_lat,t.max_lat,t.min_lon,t.max_lon
+                    FROM tiles t JOIN new_locs USING (file_loc)
+                """)
+        return len(flocs)
+
+    def record_filter(self,file_locs,new_locs = None):
+        """
+        Record that tiles were filtered out (see `post_filtering.apply_filter`)
+        Args:
+            file_locs: paths of the filtered tiles
+            new_locs: where they were moved to, in the same order; `None` if they were deleted
+        """
+        old = [os.path.abspath(f) for f in file_locs]
+        with self.con:
+            if new_locs is None:
+                self.con.executemany("UPDATE tiles SET status = 'deleted' WHERE file_loc = ?",
+                    ((f,) for f in old))
+                return
+            for o,n in zip(old,[os.path.abspath(f) for f in new_locs]):
+                if o == n:
+                    continue
+                # the move replaced whatever was at the destination (e.g. the same tile,
+                # filtered on an earlier run), so its row goes too
+                if self.rtree:
+                    self.con.execute(
+                        "DELETE FROM tile_bounds WHERE id IN (SELECT id FROM tiles WHERE file_loc = ?)",(n,))
+                self.con.execute("DELETE FROM tiles WHERE file_loc = ?",(n,))
+                self.con.execute(
+                    "UPDATE tiles SET status = 'filtered',file_loc = ?,dir = ? WHERE file_loc = ?",
+                    (n,os.path.dirname(n),o))
+
+    def query(self,bbox = None,zooms = None,tags = None,min_ovp = None,max_ovp = None,
+        dataset = None,directory = None,status = 'ok',columns = None):
+        """
+        Select tiles
+        Args:
+            bbox: optional, (lat_min,lon_min,lat_max,lon_max); tiles intersecting it are returned
+            zooms: optional, zoom level or list of zoom levels
+            tags: optional, dict of OSM tags the tiles' feature must have, e.g.
+            {'military': 'bunker'}; a value of `None` only requires the key
+            min_ovp, max_ovp: optional, range of overlap values
+            dataset: optional, dataset name or list of names
+            directory: optional, only tiles in this directory
+            status: 'ok' (the default), 'filtered', 'deleted', or `None` for all
+            columns: optional, list of columns to return
+        Returns: pandas.DataFrame
+        """
+        cols = ', '.join(f't.{c}' for c in columns) if columns else 't.*'
+        sql, where, args = f"SELECT {cols} FROM tiles t", [], []
+        if bbox is not None:
+            if self.rtree:
+                sql += " JOIN tile_bounds b ON b.id = t.id"
+                where.append("b.max_lat >= ? AND b.min_lat <= ? AND b.max_lon >= ? AND b.min_lon <= ?")
+            else:
+                where.append("t.max_lat >= ? AND t.min_lat <= ? AND t.max_lon >= ? AND t.min_lon <= ?")
+            args += [bbox[0],bbox[2],bbox[1],bbox[3]]
+        def isin(col,vals):
+            vals = [vals] if np.isscalar(vals) else list(vals)
+            where.append(f"{col} IN ({','.join('?' * len(vals))})")
+            args.extend(vals)
+        if zooms is not None:
+            isin('t.z',[int(z) for z in np.atleast_1d(zooms)])
+        if dataset is not None:
+            isin('t.dataset',dataset)
+        if status is not None:
+            isin('t.status',status)
+        if directory is not None:
+            where.append("t.dir = ?")
+            args.append(os.path.abspath(os.path.expanduser(directory)))
+        if min_ovp is not None:
+            where.append("t.overlap >= ?")
+            args.append(min_ovp)
+        if max_ovp is not None:
+            where.append("t.overlap <= ?")
+            args.append(max_ovp)
+        for k,v in (tags or {}).items():
+            path = '$."' + k.replace('"','""') + '"'
+            if v is None:
+                where.append("json_extract(t.tags,?) IS NOT NULL")
+                args.append(path)
+            else:
+                where.append("json_extract(t.tags,?) = ?")
+                args += [path,v]
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return pd.read_sql_query(sql,self.con,params = args)
+
+    def files(self,**kwargs):
+        """ paths of the tiles selected by `query(**kwargs)` """
+        return self.query(columns = ['file_loc'],**kwargs)['file_loc'].tolist()
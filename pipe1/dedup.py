@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# many tiles (open water, empty land) are byte-for-byte identical;
+# each distinct image is stored once and duplicates become hard links
+
+import os, re
+import hashlib
+import threading
+from argparse import ArgumentParser
+
+# default name of the hash manifest in a tile directory
+MANIFEST = 'tile_hashes.tsv'
+
+def tile_hash(payload):
+    """ content hash of a tile's bytes (hex string) """
+    return hashlib.blake2b(payload,digest_size = 16).hexdigest()
+
+class DedupIndex:
+    """
+    Keeps track of the distinct tile images seen so far. When a tile is stored
+    whose bytes match an earlier one, it is saved as a hard link to the first
+    copy (if `link` is True and the file system allows it) instead of a new file.
+    The index can be shared between threads (e.g. by a `DownloadController`).
+    Args:
+        link: whether to hard link duplicates; if False, every file is written
+        and duplicates are only recorded in the manifest
+    """
+    def __init__(self,link = True):
+        self.link = link
+        self.first = {} # hash -> path of the first copy
+        self.rows = [] # (file_loc,hash,size)
+        self._lock = threading.Lock()
+
+    def store(self,payload,fpath):
+        """ save `payload` to `fpath`, as a hard link if it's a duplicate """
+        h = tile_hash(payload)
+        tmp = fpath + '.part'
+        with self._lock:
+            src = self.first.get(h)
+            if src is not None and not os.path.exists(src):
+                src = None
+            if src is None:
+                self.first[h] = fpath
+            self.rows.append((fpath,h,len(payload)))
+        if src is not None and self.link:
+            try:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                os.link(src,tmp)
+                os.replace(tmp,fpath)
+                return h
+            except OSError: # e.g. a different device; just write the file
+                pass
+        with open(tmp,'wb') as f:
+            f.write(payload)
+        os.replace(tmp,fpath)
+        return h
+
+    def add_file(self,fpath):
+        """ register an existing file, replacing it by a hard link if it's a duplicate """
+        st = os.stat(fpath)
+        with open(fpath,'rb') as f:
+            payload = f.read()
+        h = tile_hash(payload)
+        with self._lock:
+            src = self.first.setdefault(h,fpath)
+            self.rows.append((fpath,h,st.st_size))
+        if src != fpath and self.link and not os.path.samefile(src,fpath):
+            tmp = fpath + '.part'
+            try:
+                os.link(src,tmp)
+                os.replace(tmp,fpath)
+            except OSError:
+                pass
+        return h
+
+    def manifest(self):
+        """
+        Returns: a pandas.DataFrame with one row per stored file: file_loc, hash,
+        size and canonical (the first file with the same content)
+        """
+        import pandas as pd # not needed for storing tiles, so not imported up front
+        df = pd.DataFrame.from_records(self.rows,columns = ['file_loc','hash','size'])
+        return df.assign(canonical = df['hash'].map(self.first))
+
+def dedup_dir(filesdir,link = True,manifest = MANIFEST):
+    """
+    Find tiles in a directory with identical contents and replace all but
+    one copy of each by hard links
+    Args:
+        filesdir: directory where we look for files
+        link: whether to hard link duplicates; if False, only the manifest is written
+        manifest: name of the .tsv file (in `filesdir`) recording the hash of each file;
+        `None` to not write one
+    Returns:
+        the manifest DataFrame (see `DedupIndex.manifest`)
+    """
+    pic_re = re.compile(r'\w+\.png$')
+    fdir = os.path.abspath(os.path.expanduser(filesdir))
+    idx = DedupIndex(link = link)
+    for f in sorted(os.listdir(fdir)):
+        if pic_re.search(f):
+            idx.add_file(fdir + '/' + f)
+    res = idx.manifest()
+    n_distinct = res['hash'].nunique()
+    print(f"{res.shape[0]} tiles, {n_distinct} distinct images")
+    if manifest is not None:
+        res.to_csv(fdir + '/' + manifest,sep = '\t',index = False)
+    return res
+
+def update_manifest(manifest,path):
+    """
+    Add rows to a manifest file, replacing the older rows of the same files
+    (other columns, e.g. the `entropy` stored by `post_filtering.filter_entropy`,
+    are kept for files whose hash hasn't changed)
+    Args:
+        manifest: DataFrame as returned by `DedupIndex.manifest`
+        path: the .tsv file (created if needed)
+    Returns:
+        the updated manifest
+    """
+    import pandas as pd
+    if os.path.exists(path):
+        old = pd.read_csv(path,sep = '\t')
+        extra = [c for c in old.columns if c not in manifest.columns]
+        if extra:
+            manifest = manifest.merge(old[['file_loc','hash'] + extra],on = ['file_loc','hash'],how = 'left')
+        manifest = pd.concat([old,manifest],ignore_index = True)
+        manifest = manifest.drop_duplicates('file_loc',keep = 'last')
+    manifest.to_csv(path,sep = '\t',index = False)
+    return manifest
+
+def hash_stats(manifest,stat,column = None):
+    """
+    Calculate an image statistic once per distinct image
+    Args:
+        manifest: DataFrame as returned by `dedup_dir`
+        stat: function taking a file path and returning a value (e.g. an entropy)
+        column: optional, a column of `manifest` with values of the statistic worked out
+        before (e.g. on an earlier run); they are reused, and only the missing ones calculated
+    Returns:
+        a pandas.Series with the statistic of each file in `manifest` (same index)
+    """
+    per_hash = {}
+    if column is not None and column in manifest.columns:
+        for h,v in zip(manifest['hash'],manifest[column]):
+            if v == v and v is not None: # not NaN
+                per_hash[h] = v
+    for h,f in zip(manifest['hash'],manifest['canonical']):
+        if h not in per_hash:
+            per_hash[h] = stat(f)
+    return manifest['hash'].map(per_hash)
+
+if __name__ == '__main__':
+
+    ap = ArgumentParser(
+    description = "replace identical tiles by hard links to a single copy"
+    )
+    ap.add_argument(
+        "--dir","-d",required = True,type = str,
+        help = "The directory where the images reside"
+    )
+    ap.add_argument(
+        "--no-link",action = 'store_true',
+        help = "Only write the manifest of hashes; don't replace any files"
+    )
+    argz = vars(ap.parse_args())
+    dedup_dir(argz['dir'],link = not argz['no_link'])
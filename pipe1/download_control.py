@@ -0,0 +1,186 @@
+# fetching tiles while adapting to the tile server: failed requests are retried
+# with exponential backoff, and the number of concurrent requests goes up while
+# the server keeps up and is cut back when it starts throttling us (AIMD)
+
+import os
+import heapq
+import random
+import statistics
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import monotonic, sleep
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+from http.client import HTTPException
+
+TILE_URL = "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png"
+USER_AGENT = "please download"
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
+# status codes worth trying again; 0 stands for a network error / timeout
+RETRY_STATUS = {0,408,429,500,502,503,504}
+THROTTLE_STATUS = {429,503}
+
+def fetch_tile(x,y,z,timeout = 30):
+    """
+    Request one tile from the tile server
+    Args:
+        x,y,z: integers
+        timeout: seconds to wait for the server
+    Returns:
+        tuple (status,payload,latency): HTTP status code (0 if the request failed
+        without one), the response body (empty unless status is 200) and the
+        elapsed time in seconds
+    """
+    url = TILE_URL.format(s = random.choice('abc'),x = x,y = y,z = z)
+    req = Request(url,headers = {'User-Agent': USER_AGENT})
+    t0 = monotonic()
+    try:
+        with urlopen(req,timeout = timeout) as resp:
+            status, payload = resp.status, resp.read()
+    except HTTPError as e:
+        status, payload = e.code, b''
+    except (URLError,OSError,HTTPException): # e.g. IncompleteRead on a truncated body
+        status, payload = 0, b''
+    return status, payload, monotonic() - t0
+
+def is_valid_tile(payload):
+    """ check that a response body is a (non-empty) PNG image """
+    return payload[:len(PNG_MAGIC)] == PNG_MAGIC
+
+def write_tile(payload,fpath):
+    """ write a tile atomically, so an interrupted write never leaves a partial file """
+    tmp = fpath + '.part'
+    with open(tmp,'wb') as f:
+        f.write(payload)
+    os.replace(tmp,fpath)
+
+def have_tile(fpath):
+    """ whether a tile was already downloaded (empty files from failed fetches don't count) """
+    return os.path.exists(fpath) and os.path.getsize(fpath) > 0
+
+class DownloadController:
+    """
+    Download tiles concurrently, adjusting the number of requests in flight:
+    after every `window` completed requests, if the share of throttled (429/503)
+    or server error responses exceeds `max_error_rate`, or the median latency
+    exceeds `max_latency`, concurrency is halved; otherwise it goes up by one.
+    Requests that fail with a retryable status are put in a bounded retry queue;
+    each one is sent again (through the same workers) once its own backoff delay,
+    exponential with jitter, has passed.
+    Args:
+        min_workers, max_workers: bounds on the number of concurrent requests
+        workers: initial number of concurrent requests
+        window: number of completed requests between adjustments
+        max_error_rate: share of error responses that triggers a slow-down
+        max_latency: median latency (in seconds) that triggers a slow-down
+        max_retries: number of retries per tile
+        base_delay, max_delay: backoff delay before the first retry, and its upper bound (seconds)
+        max_queue: size of the retry queue; tiles which don't fit are given up on
+        fetch: function (x,y,z) -> (status,payload,latency), `fetch_tile` by default
+        dedup: optional, a `dedup.DedupIndex`; tiles identical to one already downloaded
+        are then stored as hard links to it
+    """
+    def __init__(self,min_workers = 1,max_workers = 8,workers = 2,window = 20,
+        max_error_rate = 0.05,max_latency = 5.0,max_retries = 4,
+        base_delay = 1.0,max_delay = 60.0,max_queue = 10000,fetch = fetch_tile,
+        dedup = None):
+        self.min_workers, self.max_workers = min_workers, max_workers
+        self.workers = max(min_workers,min(workers,max_workers))
+        self.window = window
+        self.max_error_rate, self.max_latency = max_error_rate, max_latency
+        self.max_retries = max_retries
+        self.base_delay, self.max_delay = base_delay, max_delay
+        self.max_queue = max_queue
+        self.fetch = fetch
+        self.dedup = dedup
+        self._recent = [] # (status,latency) since the last adjustment
+        self._pause_until = 0.0
+
+    def backoff(self,attempt):
+        """ delay before retry number `attempt` (1-based): exponential, with random jitter """
+        delay = min(self.max_delay,self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0.5 * delay,delay)
+
+    def _record(self,status,latency):
+        self._recent.append((status,latency))
+        if status in THROTTLE_STATUS:
+            # everybody waits a bit before sending the next request
+            self._pause_until = max(self._pause_until,monotonic() + self.backoff(1))
+        if len(self._recent) < self.window:
+            return
+        n_err = sum(1 for s,_ in self._recent if s in THROTTLE_STATUS or s >= 500)
+        med_lat = statistics.median(l for _,l in self._recent)
+        if n_err / len(self._recent) > self.max_error_rate or med_lat > self.max_latency:
+            self.workers = max(self.min_workers,self.workers // 2)
+        else:
+            self.workers = min(self.max_workers,self.workers + 1)
+        self._recent = []
+
+    def _get(self,x,y,z,fpath):
+        wait_for = self._pause_until - monotonic()
+        if wait_for > 0:
+            sleep(wait_for)
+        status, payload, latency = self.fetch(x,y,z)
+        if status == 200 and is_valid_tile(payload):
+            if self.dedup is not None:
+                self.dedup.store(payload,fpath)
+            else:
+                write_tile(payload,fpath)
+        elif status == 200: # a 'successful' response that isn't a tile
+            status = 0
+        return status, latency
+
+    def run(self,tiles):
+        """
+        Download tiles
+        Args:
+            tiles: list of (x,y,z,fpath) tuples; tiles already at fpath are skipped
+        Returns:
+            list of (status,attempts) tuples in the order of `tiles`; status is the
+            last HTTP status received (200 on success) or -1 if the tile was skipped
+            because it was already there
+        """
+        res = [None] * len(tiles)
+        todo = deque()
+        for i,t in enumerate(tiles):
+            if have_tile(t[3]):
+                res[i] = (-1,0)
+            else:
+                todo.append(i)
+        # tiles to try again, as a heap of (not before,index): each tile backs off on its
+        # own schedule, and retries share the workers (and their limit) with new requests
+        retry = []
+        n_todo, n_done = len(todo), 0
+        with ThreadPoolExecutor(max_workers = self.max_workers) as pool:
+            running = {}
+            while todo or retry or running:
+                now = monotonic()
+                while retry and retry[0][0] <= now:
+                    todo.appendleft(heapq.heappop(retry)[1])
+                while todo and len(running) < self.workers:
+                    i = todo.popleft()
+                    running[pool.submit(self._get,*tiles[i])] = i
+                # wake up when a request completes or the next retry is due
+                timeout = max(0.0,retry[0][0] - now) if retry else None
+                if not running:
+                    sleep(timeout)
+                    continue
+                done, _ = wait(running,timeout = timeout,return_when = FIRST_COMPLETED)
+                for fut in done:
+                    i = running.pop(fut)
+                    status, latency = fut.result()
+                    self._record(status,latency)
+                    attempts = res[i][1] + 1 if res[i] is not None else 1
+                    res[i] = (status,attempts)
+                    if status in RETRY_STATUS and attempts <= self.max_retries and len(retry) < self.max_queue:
+                        heapq.heappush(retry,(monotonic() + self.backoff(attempts),i))
+                        continue
+                    n_done += 1
+                    if n_done % 50 == 0:
+                        print(f"({n_done} of {n_todo}), {self.workers} concurrent requests, {len(retry)} waiting to retry...")
+
+        n_fail = sum(1 for s,_ in res if s not in (200,-1))
+        if n_fail:
+            print(f"Failed to get {n_fail} of {len(tiles)} tiles")
+        return res
@@ -1,20 +1,18 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-import random
 import os, sys
-import subprocess as sp
 import json
-from time import sleep
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
 # the other pieces we need to run queries and get tiles 
-from .utils import deg2num, num2deg, sample_complement
-from .query_processing import process_query, find_tile_coords, calc_map_locations
+from .utils import deg2num, num2deg, sample_complement, sample_pyramid
 from .query_helpers import atomize_features
+from .download_control import DownloadController, fetch_tile, is_valid_tile, write_tile, have_tile
+from .dedup import update_manifest, MANIFEST
 
 
 def save_tile(x,y,z,fpath):
@@ -28,19 +26,22 @@ def save_tile(x,y,z,fpath):
         fpath: str
     Returns: int, 0 if successful and 1 otherwise
     """
-    url = f"https://{random.choice('abc')}.tile.openstreetmap.org/{z}/{x}/{y}.png"
-    cmd = f"wget --user-agent='please download' -O {fpath} {url}"
-    if os.path.exists(fpath):
+    if have_tile(fpath):
         print(f"Already have tile {fpath}!")
         return 0
-    try:
-        res = sp.run(cmd,shell = True,stdout = sp.PIPE,stderr = sp.STDOUT)
+    status, payload, _ = fetch_tile(x,y,z)
+    if status == 200 and is_valid_tile(payload):
+        write_tile(payload,fpath)
         return 0
-    except Exception as e:
-        print(f"Error getting tile: {e}")
-        return 1
+    print(f"Error getting tile {z}/{x}/{y}: status {status}")
+    return 1
 
-def save_tiles(df,output_dir,namefunc = None):
+def tile_name(x,y,z):
+    """ default file name of a downloaded tile """
+    return f'{z}_{x}_{y}.png'
+
+def save_tiles(df,output_dir,namefunc = None,overviews = False,
+    controller = None,journal = None,catalog = None,dataset = None):
     """
     Save the tiles whose coordinates are in the input DataFrame,
     defined by columns x, y, and z
@@ -49,35 +50,64 @@ def save_tiles(df,output_dir,namefunc = None):
         output_dir: directory where the .png files should be stored
         namefunc: optional, a function that takes arguments x,y,z and returns a file name.
         The default name function is: `f'{z}_{x}_{y}.png'` for integers x,y,z.
+        overviews: if True, zoom levels are downloaded from the largest down, and any tile
+        whose four children are already in `output_dir` is built from them locally
+        (see `overviews.build_overviews`) instead of being downloaded
+        controller: optional, a `DownloadController` to control concurrency and retries; if it
+        has a `dedup.DedupIndex`, the hashes of the tiles are recorded in `tile_hashes.tsv`
+        in `output_dir`
+        journal: optional, path of a .tsv file to which the outcome of each download
+        (x, y, z, status, attempts, file_loc) is appended
+        catalog: optional, a `catalog.TileCatalog` to which the saved tiles are added
+        dataset: optional, dataset name the tiles are recorded under in `catalog`
     Returns:
         a pandas DataFrame reflecting the tiles which were actually downloaded, adding a column
         `file_loc` identifying where on the file system the tile .png was saved
+        (and a column `derived` if `overviews` is True)
     """
     if not isinstance(df,pd.core.frame.DataFrame):
         raise TypeError("df must be a pandas DataFrame!")
     if any(e not in df.columns for e in ('z','x','y')):
         raise ValueError("df must have columns x, y, and z")
     if namefunc is None:
-        def namefunc(x,y,z):
-            return f'{z}_{x}_{y}.png'
+        namefunc = tile_name
+    if overviews:
+        from .overviews import build_overviews
+        res = []
+        for z in sorted(df['z'].unique(),reverse = True):
+            derived, todo = build_overviews(df[df['z'] == z],output_dir,namefunc = namefunc)
+            if catalog is not None:
+                catalog.add(derived,dataset)
+            res.append(derived)
+            res.append(save_tiles(todo,output_dir,namefunc,controller = controller,
+                journal = journal,catalog = catalog,dataset = dataset).assign(derived = False))
+        return pd.concat(res,axis = 0)
 
     #opath = os.path.abspath(output_dir) # for recording purposes, we don't want relative file paths
     opath = os.path.abspath(os.path.expanduser(output_dir))
     Path(opath).mkdir(parents=True, exist_ok=True)
-    L = df.shape[0]
-    flocs = [''] * L
-    for i,xyz in enumerate(zip(df['x'],df['y'],df['z'])):
-        x,y,z = xyz
-        print(f"({i+1} of {L})...")
-        if (i+1) % 50 is 0:
-            print('zzz')
-            sleep(1.33)
-        tile_name = namefunc(x,y,z)
-        outloc = opath + '/' + tile_name
-        if save_tile(x,y,z,outloc) is 0:
-            flocs[i] = outloc
+    flocs = [opath + '/' + namefunc(x,y,z) for x,y,z in zip(df['x'],df['y'],df['z'])]
+    if controller is None:
+        controller = DownloadController()
+    res = controller.run(list(zip(df['x'],df['y'],df['z'],flocs)))
+    # status -1 means the tile was already there
+    ok = np.array([status in (200,-1) for status,_ in res],dtype = bool)
     df = df.assign(file_loc = flocs)
-    return df[df['file_loc'] != '']
+    if journal is not None:
+        jdf = df[['x','y','z','file_loc']].assign(
+            status = [e[0] for e in res],attempts = [e[1] for e in res]
+        )[['x','y','z','status','attempts','file_loc']]
+        jdf.to_csv(journal,sep = '\t',index = False,mode = 'a',
+            header = not os.path.exists(journal))
+    if controller.dedup is not None:
+        # the content hashes, in `output_dir`, for `post_filtering.filter_entropy`
+        mdf = controller.dedup.manifest()
+        mdf = mdf[[os.path.dirname(f) == opath for f in mdf['file_loc']]]
+        if mdf.shape[0]:
+            update_manifest(mdf,opath + '/' + MANIFEST)
+    if catalog is not None:
+        catalog.add(df[ok],dataset)
+    return df[ok]
 
 def add_latlon(df):
     """ add latitude/longitude values to a dataframe """
@@ -85,7 +115,19 @@ def add_latlon(df):
     LLdf = pd.DataFrame.from_records(LLs,columns = ['latitude','longitude'])
     return pd.concat([df.reset_index(drop=True),LLdf],axis = 1)
 
-def basic_tileset(geo_dict, zooms, buffer = 0,n_neg = None):
+def sample_negatives(xx,yy,zoom,n,buffer = 0,sampler = 'box',region = None):
+    """
+    draw negative tiles with `sample_complement` ('box': uniformly from the bounding box
+    of the positives) or `sample_pyramid` ('pyramid': coarse-to-fine around the positives,
+    optionally restricted to `region`)
+    """
+    if sampler == 'pyramid':
+        return sample_pyramid(xx,yy,zoom,n,buffer,region = region)
+    if sampler != 'box':
+        raise ValueError(f"sampler must be 'box' or 'pyramid'; got {sampler}")
+    return sample_complement(xx,yy,n,buffer)
+
+def basic_tileset(geo_dict, zooms, buffer = 0,n_neg = None,sampler = 'box',region = None):
     """
     This function creates outputs (x,y,z) tile coordinate files which can be
     fed into download_tiles.sh or the save_tiles function to get tiles from the OSM server.
@@ -96,6 +138,10 @@ def basic_tileset(geo_dict, zooms, buffer = 0,n_neg = None):
         buffer: if nonzero, any negative tile will be at least this far away from the postive
         set, measured by L2 distance, ensuring more separation between classes if desired.
         n_neg: if provided, will fetch this many negative tiles rather than the 
+        sampler: 'box' or 'pyramid', how negative tiles are sampled (see `sample_negatives`);
+        'pyramid' scales to huge sparse areas
+        region: optional, shapely geometry in (latitude,longitude) restricting the
+        negative tiles (only with sampler = 'pyramid')
     
     Returns: dict with two pandas.DataFrame: 'positive' and 'negative'
     """
@@ -116,7 +162,8 @@ def basic_tileset(geo_dict, zooms, buffer = 0,n_neg = None):
         pos_df = pd.DataFrame.from_records(zxy,columns = ['z','x','y'])\
             .drop_duplicates(subset = ['x','y'])
         num_neg = pos_df.shape[0] if n_neg is None else int(n_neg)
-        neg_x, neg_y = sample_complement(pos_df['x'],pos_df['y'],num_neg,buffer)
+        neg_x, neg_y = sample_negatives(pos_df['x'],pos_df['y'],zoom,num_neg,buffer,
+            sampler,region)
         neg_df = pd.DataFrame({'z': zoom,'x': neg_x,'y': neg_y}).sort_values(by = ['z','x','y'])
         pos_DFs.append(pos_df)
         neg_DFs.append(neg_df)
@@ -130,42 +177,41 @@ def basic_tileset(geo_dict, zooms, buffer = 0,n_neg = None):
     return {'positive': out_pos, 'negative': out_neg }    
 
 def shapely_tileset(processed_query,min_ovp = 0,max_ovp = 1,
-    n_neg = None,buffer = 0):
+    n_neg = None,buffer = 0,sampler = 'box',region = None):
     """
     Create a DataFrame containing information on all tiles identified
     as downloadable
     Args:
-        processed_query: return value of `process_query`
+        processed_query: return value of `process_query` (or `storage.load_processed`)
         min_ovp: float in [0,1]; only keep tiles where intersection between shape and tile box is at least `min_ovp`
         max_ovp: float in [0,1]; only keep tiles where intersection between shape and tile box is at most `max_ovp`
         n_neg: int, optional; number of negative tiles to download
         buffer: int, optional; margin between positive and negative data sets (in # of tiles)
+        sampler: 'box' or 'pyramid', how negative tiles are sampled (see `sample_negatives`)
+        region: optional, shapely geometry restricting the negative tiles (with sampler = 'pyramid')
     Returns:
         A pandas DataFrame with tile locations and corresponding metadata
     """
-    types, xx, yy, qual, tags = [],[],[],[],[],[]
     z = processed_query['zoom']
-    for elem in processed_query['elements']:
-        for tile in elem['tiles']:
-            qq = tile[1]
-            if qq >= min_ovp and qq <= max_ovp:
-                x,y,_ = find_tile_coords(tile[0],z)
-                xx.append(x)
-                yy.append(y)
-                qual.append(tile[1])
-                tags.append(json.dumps(elem['tags']))
-                types.append(elem['type'])
-    
+    tiles = processed_query['tiles']
+    tiles = tiles[(tiles['overlap'] >= min_ovp) & (tiles['overlap'] <= max_ovp)]
+    # serialize the tags once per element rather than once per tile
+    elem_tags = {
+        (e['type'],e['id']): json.dumps(e.get('tags',{}))
+        for e in processed_query['elements']
+    }
+    tags = [elem_tags[key] for key in zip(tiles['type'],tiles['id'])]
+
     pos_df = pd.DataFrame({
-        'z': z, 'x' : xx, 'y': yy, 
-        'entity': types,
-        'overlap': qual,'tags': tags,
+        'z': z, 'x' : tiles['x'].values, 'y': tiles['y'].values,
+        'entity': tiles['type'].values,
+        'overlap': tiles['overlap'].values,'tags': tags,
         'placename': processed_query['query_info']['placename']
     }) \
     .drop_duplicates(subset = ['x','y']) \
     .sort_values(by = ['x','y'])
     if n_neg is None: n_neg = pos_df.shape[0]
-    negt = sample_complement(pos_df['x'],pos_df['y'],n_neg,buffer)
+    negt = sample_negatives(pos_df['x'],pos_df['y'],z,n_neg,buffer,sampler,region)
     neg_df = pd.DataFrame({'z': z,'x': negt[0],'y': negt[1]}) \
         .sort_values(by = ['x','y'])
     return { 
@@ -0,0 +1,112 @@
+# incremental re-processing: when a query is re-run, only the elements that
+# were added or changed since the previous run need new tiles
+
+import pandas as pd
+
+from .query_helpers import element_signature
+from .query_processing import process_query, TILE_COLUMNS
+from .downloading import save_tiles, tile_name
+from .post_filtering import apply_filter
+
+def diff_elements(old_elements,new_elements):
+    """
+    Compare two lists of Overpass elements by (type,id) and `element_signature`
+    Args:
+        old_elements: elements of the previous response (or of a loaded processed query)
+        new_elements: elements of the new response
+    Returns:
+        dict with 'added', 'changed', 'deleted' and 'unchanged' sets of (type,id) keys
+    """
+    old_sigs = {(e['type'],e['id']): element_signature(e) for e in old_elements}
+    new_sigs = {(e['type'],e['id']): element_signature(e) for e in new_elements}
+    common = old_sigs.keys() & new_sigs.keys()
+    changed = set(k for k in common if old_sigs[k] != new_sigs[k])
+    return {
+        'added': new_sigs.keys() - old_sigs.keys(),
+        'changed': changed,
+        'deleted': old_sigs.keys() - new_sigs.keys(),
+        'unchanged': common - changed
+    }
+
+def tile_delta(old_tiles,new_tiles):
+    """
+    Find the map tiles which have to be fetched or retracted when going
+    from one tile table to another
+    Args:
+        old_tiles, new_tiles: DataFrames with columns x, y and z
+    Returns:
+        a pandas.DataFrame with columns x, y, z and action ('add' or 'remove');
+        saved with `save_tsv`, bin/download_tiles fetches its 'add' rows (and skips
+        the others) and `post_filtering.py --manifest` retracts its 'remove' rows
+    """
+    cols = ['x','y','z']
+    both = pd.merge(
+        old_tiles[cols].drop_duplicates(),new_tiles[cols].drop_duplicates(),
+        on = cols,how = 'outer',indicator = True
+    )
+    both = both[both['_merge'] != 'both']
+    action = both['_merge'].map({'right_only': 'add','left_only': 'remove'}).astype(str)
+    return both[cols].assign(action = action.values) \
+        .sort_values(by = ['action','z','x','y']) \
+        .reset_index(drop = True)
+
+def update_processed(ovp_query,previous,zoom = None,**kwargs):
+    """
+    Incremental version of `process_query`: tiles of elements which are unchanged
+    since `previous` are reused, tiles of deleted elements are dropped, and only
+    added or changed elements are processed.
+    Args:
+        ovp_query: the new Overpass API response
+        previous: the processed previous response (from `process_query` or `storage.load_processed`)
+        zoom: zoom level; defaults to the zoom of `previous`
+        **kwargs: forwarded to `process_query` (max_tiles_per_entity, min_ovp, max_ovp)
+    Returns:
+        tuple (processed,delta): the processed new query (as from `process_query`)
+        and the tile delta (as from `tile_delta`) relative to `previous`
+    """
+    if zoom is None:
+        zoom = previous['zoom']
+    if zoom != previous['zoom']:
+        raise ValueError(f"previous query was processed at zoom {previous['zoom']}, not {zoom}")
+    diff = diff_elements(previous['elements'],ovp_query['elements'])
+    print(
+        f"{len(diff['added'])} added, {len(diff['changed'])} changed, "
+        f"{len(diff['deleted'])} deleted, {len(diff['unchanged'])} unchanged elements"
+    )
+    old_tiles = previous['tiles']
+    keep = [k in diff['unchanged'] for k in zip(old_tiles['type'],old_tiles['id'])]
+    tiles = [old_tiles[keep]]
+    redo = diff['added'] | diff['changed']
+    todo = [e for e in ovp_query['elements'] if (e['type'],e['id']) in redo]
+    if len(todo):
+        tiles.append(process_query({'elements': todo},zoom,**kwargs)['tiles'])
+    res = dict(ovp_query)
+    res['zoom'] = zoom
+    res['tiles'] = pd.concat(tiles,axis = 0,ignore_index = True)[TILE_COLUMNS]
+    res['total_tiles'] = res['tiles'].shape[0]
+    return res, tile_delta(old_tiles,res['tiles'])
+
+def apply_delta(delta,output_dir,retired_dir = None,namefunc = None,
+    controller = None,catalog = None,dataset = None):
+    """
+    Bring a tile directory up to date with a tile delta: download the
+    added tiles and move (or delete) the removed ones
+    Args:
+        delta: return value of `tile_delta`/`update_processed`
+        output_dir: directory holding the tiles of the previous run
+        retired_dir: where to move the removed tiles (`None` to delete them); as in
+        `apply_filter`, a relative path is relative to `output_dir`
+        namefunc: optional, file name function as in `save_tiles`
+        controller, catalog, dataset: optional, as in `save_tiles`; removed tiles
+        are marked as filtered (or deleted) in `catalog`
+    Returns:
+        the return value of `save_tiles` for the added tiles
+    """
+    removed = delta[delta['action'] == 'remove']
+    if removed.shape[0]:
+        name = namefunc or tile_name
+        imgs = [name(x,y,z) for x,y,z in zip(removed['x'],removed['y'],removed['z'])]
+        apply_filter(output_dir,imgs,retired_dir,catalog = catalog)
+    added = delta[delta['action'] == 'add'].drop(columns = 'action')
+    return save_tiles(added,output_dir,namefunc,controller = controller,
+        catalog = catalog,dataset = dataset)
@@ -0,0 +1,175 @@
+# pixel-level label masks: where the queried features fall within each positive tile
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from .utils import deg2pixel
+from .query_helpers import way_coords
+from .query_processing import is_basically_closed, way_is_closed, relation_rings
+from .downloading import tile_name
+
+# largest canvas (in pixels) an element is drawn on in one go; elements whose
+# tiles span more than this are drawn tile by tile instead
+MAX_CANVAS = 4096 * 4096
+
+def mask_name(x,y,z):
+    """ default mask file name; unlike `downloading.tile_name`, so masks can sit next to their tiles """
+    return f'{z}_{x}_{y}_mask.png'
+
+def element_shapes(elem):
+    """
+    The parts of an Overpass element to draw in a mask
+    Args:
+        elem: an element of an Overpass response (with geometry, i.e. `out geom`)
+    Returns:
+        list of (kind,lats,lons,fill) tuples, where kind is 'polygon', 'line' or 'point',
+        in drawing order; the member ways of relations are assembled into rings
+        (see `query_processing.relation_rings`), and holes come last with fill 0
+    """
+    def way_shape(way):
+        coords = way_coords(way)
+        if 'nodes' in way:
+            closed = way_is_closed(way,coords)
+        else:
+            closed = len(coords) > 3 and is_basically_closed(coords)
+        return ('polygon' if closed else 'line',*arrays(coords),1)
+
+    def arrays(coords):
+        return np.array([c[0] for c in coords]), np.array([c[1] for c in coords])
+
+    if elem['type'] == 'node':
+        return [('point',np.array([elem['lat']]),np.array([elem['lon']]),1)]
+    if elem['type'] == 'way':
+        return [way_shape(elem)] if len(way_coords(elem)) > 1 else []
+    outer, inner, loose = relation_rings(elem)
+    shapes = [('polygon',*arrays(r),1) for r in outer] + [('line',*arrays(w),1) for w in loose]
+    for mem in elem.get('members',[]):
+        if mem['type'] == 'node' and 'lat' in mem:
+            shapes.append(('point',np.array([mem['lat']]),np.array([mem['lon']]),1))
+    return shapes + [('polygon',*arrays(r),0) for r in inner] # holes last
+
+def _draw(canvas,shapes,x0,y0,line_px,node_px):
+    # shapes are already in global pixel coordinates; (x0,y0) is the canvas origin
+    draw = ImageDraw.Draw(canvas)
+    for kind,px,py,fill in shapes:
+        pts = list(zip(px - x0,py - y0))
+        if kind == 'polygon':
+            draw.polygon(pts,fill = fill)
+        elif kind == 'line':
+            draw.line(pts,fill = fill,width = line_px)
+        else:
+            (cx,cy), r = pts[0], node_px
+            draw.ellipse([cx - r,cy - r,cx + r,cy + r],fill = fill)
+
+def tile_masks(processed_query,tiles,output_dir = None,namefunc = None,out = None,
+    n_jobs = 4,tile_px = 256,line_px = 3,node_px = 4):
+    """
+    Rasterize the features of a processed query into a label mask for each tile
+    (1 where a feature is, 0 elsewhere). Each element is projected to pixel coordinates
+    once, and drawn once on a canvas covering all of its tiles, which is then cut up
+    into the individual tile masks.
+    Args:
+        processed_query: return value of `process_query` (elements need their geometry,
+        so a query loaded by `storage.load_processed` won't do)
+        tiles: positive tile table with columns x, y and z (e.g. from `shapely_tileset`);
+        only tiles at the zoom of `processed_query` are used
+        output_dir: optional, directory in which the masks are saved as .png files
+        namefunc: optional, file name function as in `save_tiles`; `mask_name` by default
+        (names of the tile images themselves are refused if those tiles are in `output_dir`)
+        out: optional, a preallocated uint8 array (e.g. a `numpy.memmap`) of shape
+        (len(tiles), tile_px, tile_px) to write the masks into, in the row order of `tiles`
+        n_jobs: number of threads writing .png files
+        tile_px: size of a tile in pixels
+        line_px: width of open ways, in pixels
+        node_px: radius of nodes, in pixels
+    Returns:
+        if `output_dir` is given, `tiles` with an added column `mask_loc`;
+        otherwise the array of masks
+    """
+    z = processed_query['zoom']
+    if namefunc is None:
+        namefunc = mask_name
+    if out is None and output_dir is None:
+        out = np.zeros((tiles.shape[0],tile_px,tile_px),dtype = np.uint8)
+    if out is not None and out.shape != (tiles.shape[0],tile_px,tile_px):
+        raise ValueError(f"out must have shape {(tiles.shape[0],tile_px,tile_px)}; got {out.shape}")
+    rows = {} # (x,y) -> row numbers in `tiles`
+    for i,xyz in enumerate(zip(tiles['x'],tiles['y'],tiles['z'])):
+        if xyz[2] == z:
+            rows.setdefault((int(xyz[0]),int(xyz[1])),[]).append(i)
+    tx = np.array([k[0] for k in rows],dtype = np.int64)
+    ty = np.array([k[1] for k in rows],dtype = np.int64)
+    masks = {} # (x,y) -> mask, when writing .png files
+
+    def target(key):
+        if out is not None:
+            return out[rows[key][0]]
+        if key not in masks:
+            masks[key] = np.zeros((tile_px,tile_px),dtype = np.uint8)
+        return masks[key]
+
+    for elem in processed_query['elements']:
+        if elem['type'] != 'node' and 'geometry' not in elem and 'members' not in elem:
+            raise ValueError("tile_masks needs the element geometries of the query")
+        shapes = []
+        for kind,lats,lons,fill in element_shapes(elem):
+            px, py = deg2pixel(lats,lons,z,tile_px)
+            shapes.append((kind,px,py,fill))
+        if not len(shapes):
+            continue
+        allx = np.concatenate([s[1] for s in shapes])
+        ally = np.concatenate([s[2] for s in shapes])
+        pad = max(line_px,node_px)
+        # positive tiles touched by the element's bounding box
+        sel = (tx >= (allx.min() - pad) // tile_px) & (tx <= (allx.max() + pad) // tile_px) & \
+            (ty >= (ally.min() - pad) // tile_px) & (ty <= (ally.max() + pad) // tile_px)
+        if not sel.any():
+            continue
+        ex, ey = tx[sel], ty[sel]
+        x0, y0 = ex.min(), ey.min()
+        W, H = (ex.max() - x0 + 1) * tile_px, (ey.max() - y0 + 1) * tile_px
+        if W * H <= MAX_CANVAS:
+            canvas = Image.new('L',(int(W),int(H)),0)
+            _draw(canvas,shapes,x0 * tile_px,y0 * tile_px,line_px,node_px)
+            arr = np.asarray(canvas)
+            for x,y in zip(ex,ey):
+                r, c = (y - y0) * tile_px, (x - x0) * tile_px
+                m = target((int(x),int(y)))
+                np.maximum(m,arr[r:r + tile_px,c:c + tile_px],out = m)
+        else:
+            for x,y in zip(ex,ey):
+                canvas = Image.new('L',(tile_px,tile_px),0)
+                _draw(canvas,shapes,x * tile_px,y * tile_px,line_px,node_px)
+                m = target((int(x),int(y)))
+                np.maximum(m,np.asarray(canvas),out = m)
+
+    if out is not None:
+        # tiles listed more than once get the same mask
+        for idx in rows.values():
+            for i in idx[1:]:
+                out[i] = out[idx[0]]
+        if output_dir is None:
+            return out
+        masks = {k: out[idx[0]] for k,idx in rows.items()}
+
+    opath = os.path.abspath(os.path.expanduser(output_dir))
+    os.makedirs(opath,exist_ok = True)
+    clash = [namefunc(x,y,z) for x,y in rows if namefunc(x,y,z) == tile_name(x,y,z)]
+    if any(os.path.exists(opath + '/' + f) for f in clash):
+        raise ValueError(f"{opath} has tiles under the names the masks would get; use another namefunc or output_dir")
+    def save(key):
+        floc = opath + '/' + namefunc(key[0],key[1],z)
+        m = masks.get(key)
+        if m is None:
+            m = np.zeros((tile_px,tile_px),dtype = np.uint8)
+        Image.fromarray(m).save(floc)
+        return floc
+    keys = list(rows.keys())
+    with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+        flocs = dict(zip(keys,pool.map(save,keys)))
+    mask_loc = [flocs.get((int(x),int(y)),'') if zz == z else ''
+        for x,y,zz in zip(tiles['x'],tiles['y'],tiles['z'])]
+    return tiles.assign(mask_loc = mask_loc)
@@ -0,0 +1,101 @@
+# stitching neighbouring tiles into larger windows, for models that
+# need more context than a single tile
+
+import os
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from .downloading import save_tiles, tile_name
+from .download_control import have_tile
+
+def window_offsets(k):
+    """ (dx,dy) offsets of the tiles in a k x k window centred on a tile, in reading order """
+    if k < 1 or k % 2 == 0:
+        raise ValueError(f"window size must be a positive odd integer; got {k}")
+    r = k // 2
+    return [(dx,dy) for dy in range(-r,r+1) for dx in range(-r,r+1)]
+
+def window_tiles(df,k):
+    """
+    All distinct tiles needed to build k x k windows around the tiles in `df`;
+    neighbouring windows share most of their tiles, so this is much smaller
+    than k*k times the number of rows
+    Args:
+        df: pandas.DataFrame with columns x, y and z
+        k: window size (odd)
+    Returns: a pandas.DataFrame with columns z, x and y
+    """
+    offs = np.array(window_offsets(k))
+    # tables from `storage.load_tileset` have compact dtypes (z is int8,
+    # so 2 ** z would overflow)
+    xx = (df['x'].values.astype(np.int64)[:,None] + offs[None,:,0]).ravel()
+    yy = (df['y'].values.astype(np.int64)[:,None] + offs[None,:,1]).ravel()
+    zz = np.repeat(df['z'].values.astype(np.int64),len(offs))
+    # tiles wrap around in the x direction but not in the y direction
+    xx = xx % (2 ** zz)
+    ok = (yy >= 0) & (yy < 2 ** zz)
+    return pd.DataFrame({'z': zz[ok],'x': xx[ok],'y': yy[ok]}).drop_duplicates()
+
+def tile_mosaics(df,k,tile_dir,namefunc = None,fetch = True,out = None,tile_px = 256):
+    """
+    Build a k x k mosaic centred on each tile in `df`. Each distinct tile is
+    read only once and copied into its place in every window that contains it.
+    Missing tiles are downloaded into `tile_dir` with `save_tiles` (if `fetch`)
+    and are left black if they still can't be found.
+    Args:
+        df: pandas.DataFrame with columns x, y and z
+        k: window size (odd)
+        tile_dir: directory where the tiles are cached
+        namefunc: optional, file name function as in `save_tiles`
+        fetch: whether to download tiles which are not in `tile_dir`
+        out: optional, a preallocated uint8 array (e.g. a `numpy.memmap`) of shape
+        (len(df), k*tile_px, k*tile_px, 3) to write the mosaics into
+        tile_px: size of a tile in pixels
+    Returns: the array of mosaics, in the row order of `df`
+    """
+    if namefunc is None:
+        namefunc = tile_name
+    tdir = os.path.abspath(os.path.expanduser(tile_dir))
+    shape = (df.shape[0],k * tile_px,k * tile_px,3)
+    if out is None:
+        out = np.zeros(shape,dtype = np.uint8)
+    elif out.shape != shape:
+        raise ValueError(f"out must have shape {shape}; got {out.shape}")
+
+    needed = window_tiles(df,k)
+    if fetch:
+        # empty files from failed downloads are fetched again
+        missing = [not have_tile(tdir + '/' + namefunc(x,y,z))
+            for x,y,z in zip(needed['x'],needed['y'],needed['z'])]
+        if any(missing):
+            save_tiles(needed[missing],tdir,namefunc)
+
+    # for each distinct tile, the (window,row,column) places it goes to
+    places = {}
+    for w,xyz in enumerate(zip(df['x'],df['y'],df['z'])):
+        x,y,z = (int(e) for e in xyz)
+        for i,(dx,dy) in enumerate(window_offsets(k)):
+            if y + dy < 0 or y + dy >= 2 ** z:
+                continue
+            key = ((x + dx) % (2 ** z),y + dy,z)
+            places.setdefault(key,[]).append((w,i // k,i % k))
+
+    n_missing = 0
+    for (x,y,z),targets in places.items():
+        floc = tdir + '/' + namefunc(x,y,z)
+        if not have_tile(floc):
+            n_missing += 1
+            continue
+        try:
+            with Image.open(floc) as img:
+                arr = np.asarray(img.convert('RGB'))
+        except OSError: # not a readable image
+            n_missing += 1
+            continue
+        for w,r,c in targets:
+            out[w,r*tile_px:(r+1)*tile_px,c*tile_px:(c+1)*tile_px] = arr
+    if n_missing:
+        print(f"{n_missing} of {len(places)} tiles were not available; left blank")
+    return out
@@ -0,0 +1,103 @@
+# building lower-zoom tiles locally from their already downloaded children
+# rather than fetching them from the tile server
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from PIL import Image
+
+from .downloading import tile_name
+
+def child_tiles(x,y,z):
+    """ the four tiles at zoom z+1 which make up tile (x,y) at zoom z, in reading order """
+    return [(2*x + dx,2*y + dy,z + 1) for dy in (0,1) for dx in (0,1)]
+
+def composite_tile(child_paths,outloc):
+    """
+    Stitch four child tiles (in the order of `child_tiles`) into one image
+    and downsample it to the size of a single tile
+    Args:
+        child_paths: list of the 4 file paths
+        outloc: where to save the resulting .png
+    Returns: outloc
+    """
+    imgs = [Image.open(p).convert('RGB') for p in child_paths]
+    w, h = imgs[0].size
+    canvas = Image.new('RGB',(2*w,2*h))
+    for i,img in enumerate(imgs):
+        canvas.paste(img,((i % 2) * w,(i // 2) * h))
+        img.close()
+    # BOX averages each 2x2 block, which is what the downsampling should do
+    canvas.resize((w,h),resample = Image.BOX).save(outloc)
+    return outloc
+
+def _existing(dirs):
+    # one directory scan per location, instead of a stat call per tile; empty files
+    # (left by failed downloads) don't count, as in `download_control.have_tile`
+    def scan(d):
+        with os.scandir(d) as it:
+            return set(e.name for e in it if e.is_file() and e.stat().st_size > 0)
+    return {d: scan(d) if os.path.isdir(d) else set() for d in dirs}
+
+def build_overviews(df,output_dir,search_dirs = None,namefunc = None,n_jobs = 4):
+    """
+    For tiles in `df` whose four children have already been downloaded, build
+    the tile locally instead of fetching it. Zoom levels are handled from the
+    largest down, so tiles built at one zoom can serve as children for the next.
+    Derived tiles are not identical to server-rendered ones (labels and line widths
+    are scaled with the zoom), so they are marked with `derived = True`.
+    Args:
+        df: pandas.DataFrame with columns x, y and z (e.g. from `basic_tileset`)
+        output_dir: directory where the tiles are stored; children are looked up here
+        search_dirs: optional list of extra directories where children may be found
+        namefunc: optional, file name function as in `save_tiles`
+        n_jobs: number of threads compositing tiles
+    Returns:
+        tuple (derived,remaining) of DataFrames: the tiles which were built, with the
+        `file_loc` and `derived` columns added as in `save_tiles`, and the rest of `df`
+        which still has to be downloaded
+    """
+    if namefunc is None:
+        namefunc = tile_name
+    opath = os.path.abspath(os.path.expanduser(output_dir))
+    os.makedirs(opath,exist_ok = True)
+    dirs = [opath] + [os.path.abspath(os.path.expanduser(d)) for d in (search_dirs or [])]
+    have = _existing(dirs)
+
+    def locate(x,y,z):
+        name = namefunc(x,y,z)
+        for d in dirs:
+            if name in have[d]:
+                return d + '/' + name
+        return None
+
+    derived, remaining = [], []
+    with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+        for z in sorted(df['z'].unique(),reverse = True):
+            dz = df[df['z'] == z]
+            jobs, flocs = [], []
+            for x,y in zip(dz['x'],dz['y']):
+                outloc = opath + '/' + namefunc(x,y,z)
+                kids = [locate(*c) for c in child_tiles(x,y,z)]
+                if locate(x,y,z) is not None or any(k is None for k in kids):
+                    flocs.append('')
+                    continue
+                jobs.append((len(flocs),pool.submit(composite_tile,kids,outloc)))
+                flocs.append(outloc)
+            for i,job in jobs:
+                try:
+                    job.result()
+                except OSError as e: # e.g. a corrupt child; download this one instead
+                    print(f"Could not build {flocs[i]}: {e}")
+                    flocs[i] = ''
+            # the new tiles can be children of tiles at the next zoom level:
+            have[opath].update(os.path.basename(f) for f in flocs if f)
+            dz = dz.assign(file_loc = flocs)
+            derived.append(dz[dz['file_loc'] != ''].assign(derived = True))
+            remaining.append(dz[dz['file_loc'] == ''].drop(columns = 'file_loc'))
+    if not len(derived):
+        return df.iloc[:0].assign(file_loc = '',derived = True), df
+    nd = sum(e.shape[0] for e in derived)
+    print(f"Built {nd} of {df.shape[0]} tiles from their children.")
+    return pd.concat(derived,axis = 0), pd.concat(remaining,axis = 0)
@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-import os, re, contextlib
-# cofusingly, the package is called 'Pillow' but
-# the module name is still PIL (Python Imaging Library)
-from PIL import Image, ImageMath
+import os, re, csv, sys, contextlib
 from argparse import ArgumentParser
 
+try:
+    from .dedup import tile_hash, hash_stats, MANIFEST
+except ImportError: # run as a script
+    from dedup import tile_hash, hash_stats, MANIFEST
+
 @contextlib.contextmanager
 def working_directory(path):
     """
@@ -20,42 +22,86 @@ def working_directory(path):
     finally:
         os.chdir(prev_wd)
 
-def filter_size(filesdir: str,min_size: int):
+def filter_size(filesdir: str,min_size: int,catalog = None):
     """
     Find files less than a given size and return their paths
     (to get all the image sizes, simply pass a huge `min_size`)
     Args:
         filesdir: directory where we look for files
         min_size: cutoff size (in bytes); any image smaller is returned
+        catalog: optional, a `catalog.TileCatalog`; the sizes recorded there are used
+        instead of listing the directory
     Return: List of (name,size) tuples of images
     """
+    if catalog is not None:
+        df = catalog.query(directory = filesdir,columns = ['file_loc','size'])
+        return [(os.path.basename(f),int(sz)) for f,sz in zip(df['file_loc'],df['size'])
+            if sz is not None and sz == sz and sz <= min_size]
     with working_directory(filesdir):
         pic_re = re.compile(r'\w+\.png$')
         ff = [f for f in os.listdir() if pic_re.search(f)]
         fs = [os.path.getsize(f) for f in ff]
     return [(f,sz) for f,sz in zip(ff,fs) if sz <= min_size]
 
-def filter_entropy(filesdir: str,min_e: float):
+def filter_entropy(filesdir: str,min_e: float,manifest = MANIFEST):
     """
     calculate the entropy and filter files lower than a given
-    threshold
+    threshold; identical images (e.g. empty tiles) are only decoded once (see
+    `dedup.hash_stats`), and the entropies are stored in an `entropy` column of the
+    hash manifest so that later calls don't decode them again
     Args:
         filesdir: directory where we look for files
         min_size: cutoff size; images with smaller entropy are returned
+        manifest: name of the hash manifest in `filesdir`, as written by `dedup.dedup_dir`
+        or `save_tiles` (created if needed); the hashes of files whose size hasn't changed
+        are taken from it. `None` to neither read nor write one
     Return: List of (name,size) tuples of images
     """
+    # cofusingly, the package is called 'Pillow' but
+    # the module name is still PIL (Python Imaging Library)
+    from PIL import Image
+    import pandas as pd
     pic_re = re.compile(r'\w+\.png$')
+    fdir = os.path.abspath(os.path.expanduser(filesdir))
+    mpath = os.path.join(fdir,manifest) if manifest else None
+    known, known_e = {}, {} # file name -> (hash,size); hash -> entropy
+    if mpath is not None and os.path.exists(mpath):
+        mdf = pd.read_csv(mpath,sep = '\t')
+        known = {os.path.basename(f): (h,sz) for f,h,sz in zip(mdf['file_loc'],mdf['hash'],mdf['size'])}
+        if 'entropy' in mdf.columns:
+            known_e = dict(zip(mdf['hash'],mdf['entropy']))
+
+    rows = []
+    by_inode = {} # (device,inode) -> hash, for hard links
+    for f in sorted(os.listdir(fdir)):
+        if not pic_re.search(f):
+            continue
+        st = os.stat(fdir + '/' + f)
+        ino = (st.st_dev,st.st_ino)
+        h, size = known.get(f,(None,None))
+        if size != st.st_size: # not in the manifest, or changed since
+            h = by_inode.get(ino)
+            if h is None:
+                with open(fdir + '/' + f,'rb') as fh:
+                    h = tile_hash(fh.read())
+        by_inode[ino] = h
+        rows.append((fdir + '/' + f,h,st.st_size))
+    df = pd.DataFrame.from_records(rows,columns = ['file_loc','hash','size'])
+    df = df.assign(
+        canonical = df.groupby('hash')['file_loc'].transform('first'),
+        entropy = df['hash'].map(known_e)
+    )
 
     def img_entropy(imgpath):
         with Image.open(imgpath,'r') as img:
             return img.entropy()
 
-    with working_directory(filesdir):
-        ff = [f for f in os.listdir(filesdir) if pic_re.search(f)]
-        ee = [img_entropy(e) for e in ff]
-    return [(f,e) for f,e in zip(ff,ee) if e <= min_e]
+    df['entropy'] = hash_stats(df,img_entropy,column = 'entropy')
+    if mpath is not None:
+        df.to_csv(mpath,sep = '\t',index = False)
+    return [(os.path.basename(f),e) for f,e in zip(df['file_loc'],df['entropy']) if e <= min_e]
 
-def apply_filter(filesdir,imgs,outdir = None):
+def apply_filter(filesdir,imgs,outdir = None,catalog = None):
     """
     Having used some filters to identify 'bad' images, move them into
     `outdir`; if that is `None`, then simply deletes `imgs`.
@@ -63,13 +109,19 @@ def apply_filter(filesdir,imgs,outdir = None):
         filesdir: directory where the images are
         imgs: images we want to move or delete
         outdir: destination of images (`None` to delete them)
+        catalog: optional, a `catalog.TileCatalog` in which the images are marked
+        as filtered (or deleted)
     """
     with working_directory(filesdir):
         imgs = [e for e in imgs if os.path.exists(e)]
         print(f"Identified {len(imgs)} files to filter")
+        # the catalogue is updated right after each file, so it stays
+        # in step with the directory if this is interrupted
         if outdir is None:
-            for img in images:
+            for img in imgs:
                 os.remove(img)
+                if catalog is not None:
+                    catalog.record_filter([img])
         else:
             if outdir.endswith('/'): outdir = outdir[:-1]
             if not os.path.exists(outdir):
@@ -77,6 +129,22 @@ def apply_filter(filesdir,imgs,outdir = None):
             for img in imgs:
                 img = img.split('/')[-1]
                 os.rename(img,f"{outdir}/{img}")
+                if catalog is not None:
+                    catalog.record_filter([img],[f"{outdir}/{img}"])
+
+def removed_tiles(manifest):
+    """
+    Read the tiles to retract from a tile delta written as .tsv
+    (see `incremental.tile_delta`), to be passed to `apply_filter`
+    Args:
+        manifest: path of the .tsv file, with columns x, y, z and action
+    Return: List of file names (`{z}_{x}_{y}.png`, as `save_tiles` names them)
+    """
+    with open(manifest,newline = '') as f:
+        return [
+            f"{row['z']}_{row['x']}_{row['y']}.png"
+            for row in csv.DictReader(f,delimiter = '\t') if row.get('action') == 'remove'
+        ]
 
 
 if __name__ == '__main__':
@@ -89,9 +157,13 @@ if __name__ == '__main__':
         help = "The directory where the images reside"
     )
     ap.add_argument(
-        "--min_size","-m",required = True,type = int,
+        "--min_size","-m",required = False,type = int,default = None,
         help = "The file size in bytes (anything smaller is (re)moved)"
     )
+    ap.add_argument(
+        "--manifest",required = False,type = str,default = None,
+        help = "A tile delta .tsv (x, y, z, action); its 'remove' tiles are (re)moved instead of filtering by size"
+    )
     ap.add_argument(
         "--min_entropy","-e",required = False,
         type = float,nargs = '?',default = None,
@@ -106,6 +178,11 @@ if __name__ == '__main__':
     
     wkdir = argz['dir']
     odir = argz['outdir']
+    if argz['manifest'] is not None:
+        apply_filter(wkdir,removed_tiles(argz['manifest']),odir)
+        sys.exit(0)
+    if argz['min_size'] is None:
+        ap.error("one of --min_size or --manifest is required")
     filter1 = filter_size(wkdir,argz['min_size'])
     if argz['min_entropy']:
         filter2 = filter_entropy(wkdir,argz['min_entropy'])
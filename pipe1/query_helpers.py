@@ -1,7 +1,97 @@
-from osmxtract import overpass, location
+import re, json, hashlib
 from collections import Counter
+from urllib.request import Request, urlopen
+from urllib.parse import urlencode
+from urllib.error import HTTPError
 
-def run_ql_query(place,tag,values,buffersize = None,case = False,timeout = 25):
+OVERPASS_URL = 'http://overpass-api.de/api/interpreter'
+
+# Overpass output modes: what is returned for each element
+# (the `geom` modifier adds coordinates to ways and relation members)
+OUTPUT_MODES = {
+    'body': 'out geom',     # ids, tags and geometry (what osmxtract requests)
+    'ids': 'out ids geom',  # ids and geometry, no tags
+    'skel': 'out skel geom' # bare geometry, e.g. for `basic_tileset`
+}
+
+# characters with a special meaning in Overpass (POSIX extended) regular expressions
+REGEX_SPECIAL = re.compile(r'([\\.^$|?*+()\[\]{}])')
+
+def _ql_string(s):
+    # a double-quoted Overpass QL string
+    return '"' + s.replace('\\','\\\\').replace('"','\\"') + '"'
+
+def _value_regex(v,case):
+    # a tag value as a regular expression matching it literally,
+    # with the first letter case-insensitive if `case`
+    if case and v[:1].lower() != v[:1].upper():
+        return f'[{v[0].lower()}{v[0].upper()}]' + REGEX_SPECIAL.sub(r'\\\1',v[1:])
+    return REGEX_SPECIAL.sub(r'\\\1',v)
+
+def build_ql_query(bounds,tag,values = None,case = False,timeout = 25,
+    output = 'body',clip = False,exact = False):
+    """
+    Build an Overpass QL query for elements with a given tag in a bounding box,
+    requesting no more output than needed
+    Args:
+        bounds: (lat_min, lon_min, lat_max, lon_max)
+        tag: OSM tag key (ex. 'leisure')
+        values: optional, list of accepted values of the tag; they are matched literally
+        (characters like '.' or '(' in a value have no special meaning)
+        case: if True, the first letter of the values is matched case-insensitively
+        timeout: Overpass timeout (seconds)
+        output: one of the keys of `OUTPUT_MODES`
+        clip: if True, only return the parts of the geometries inside `bounds`;
+        note that clipped ways are generally no longer closed
+        exact: only used with several values or `case`, which are matched with a regular
+        expression: if False (the default, as osmxtract does) a tag value matches if it
+        contains one of `values` (e.g. 'park' matches 'dog_park'); if True, it has to be
+        one of them
+    Returns: str, the query
+    """
+    if output not in OUTPUT_MODES:
+        raise ValueError(f"output must be one of {list(OUTPUT_MODES)}; got {output}")
+    if values:
+        if len(values) > 1 or case:
+            rx = '|'.join(_value_regex(v,case) for v in values)
+            if exact:
+                rx = f'^({rx})$'
+            filt = f'[{_ql_string(tag)}~{_ql_string(rx)}]'
+        else:
+            filt = f'[{_ql_string(tag)}={_ql_string(values[0])}]'
+    else:
+        filt = f'[{_ql_string(tag)}]'
+    bbox = ','.join(str(b) for b in bounds)
+    out = OUTPUT_MODES[output] + (f'({bbox})' if clip else '')
+    return f'[out:json][timeout:{timeout}]; nwr{filt}({bbox}); {out} qt;'
+
+def overpass_request(query,endpoint = OVERPASS_URL):
+    """
+    Send a query to the Overpass API
+    Args:
+        query: Overpass QL query (as from `build_ql_query`)
+        endpoint: URL of the API
+    Returns: tuple (response,nbytes): the parsed JSON response and its size in bytes
+    """
+    req = Request(endpoint,data = urlencode({'data': query}).encode('utf-8'),
+        headers = {'User-Agent': 'pipe1'})
+    try:
+        with urlopen(req) as resp:
+            payload = resp.read()
+    except HTTPError as e:
+        raise RuntimeError(f"Overpass request failed with status {e.code}: {e.reason}") from e
+    return json.loads(payload), len(payload)
+
+def select_tags(ovp_response,tag_keys):
+    """ keep only the tags in `tag_keys` for each element of a response (modifies it in place) """
+    keep = set(tag_keys)
+    for elem in ovp_response['elements']:
+        if 'tags' in elem:
+            elem['tags'] = {k: v for k,v in elem['tags'].items() if k in keep}
+    return ovp_response
+
+def run_ql_query(place,tag,values,buffersize = None,case = False,timeout = 25,
+    output = 'body',clip = False,tag_keys = None,exact = False):
     """
     Run an overpass API query
 
@@ -10,10 +100,19 @@ def run_ql_query(place,tag,values,buffersize = None,case = False,timeout = 25):
         or a (latitiude,longitude) tuple, or a tuple of 4 numbers which will
         be considered to be the bounds (and in this case we ignore buffersize)
         buffersize: size, in meters
+        output: 'body' (ids, tags and geometry), 'ids' (ids and geometry) or 'skel'
+        (bare geometry, enough for `basic_tileset`); see `build_ql_query`
+        clip: if True, geometries are clipped to the bounds by the server
+        tag_keys: optional, list of tag keys to keep (all others are dropped after
+        the response arrives; Overpass can't leave them out)
+        exact: if True, several `values` have to match a tag value exactly, not
+        just be part of it; see `build_ql_query`
     Returns: JSON result of an Overpass API query, with some extra metadata 
         about the query appended.
 
     """
+    # osmxtract pulls in rasterio, fiona, etc. so only import it when needed
+    from osmxtract import location
     # Determine the bounds
     if type(place) in (str,int):
         lat, lon = location.geocode(place)
@@ -32,20 +131,31 @@ def run_ql_query(place,tag,values,buffersize = None,case = False,timeout = 25):
         bounds = place 
     else:
         bounds = location.from_buffer(lat, lon, buffer_size = buffersize)
-    query = overpass.ql_query(bounds, tag, values,case,timeout)
-    res = overpass.request(query)
+    query = build_ql_query(bounds,tag,values,case,timeout,output = output,clip = clip,exact = exact)
+    res, nbytes = overpass_request(query)
+    if tag_keys is not None:
+        select_tags(res,tag_keys)
+    print(f"Overpass response: {len(res['elements'])} elements, {nbytes / 1e6:.2f} MB")
     # append info about the query so it's automatically tracked
     res['query_info'] = {
         'query': query,
         'placename': place if type(place) in (str,int) else None,
         'geolocation': (lat,lon),
         'bounds': bounds,
-        'types': Counter(e['type'] for e in res['elements'])
+        'types': Counter(e['type'] for e in res['elements']),
+        'response_bytes': nbytes
     }
     if len(res['elements']) is 0:
         print("*****\n\nWarning: empty query!!!\n\n*****")
     return res
     
+def way_coords(way):
+    """
+    (lat,lon) tuples of a way (or relation member) with geometry; with `clip = True`
+    (see `build_ql_query`) the points outside the bounds come back as null and are left out
+    """
+    return [(p['lat'],p['lon']) for p in way.get('geometry') or [] if p]
+
 def atomize_features(ovp_response):
     """
     if we want to turn a response into a bag of homogeneous nodes,
@@ -55,13 +165,12 @@ def atomize_features(ovp_response):
     Returns:
     """
 
-    def way_to_nodes(way):
-        LAT = [coordinate['lat'] for coordinate in way['geometry']]
-        LON = [coordinate['lon'] for coordinate in way['geometry']]
+    def way_to_nodes(way,feature):
+        # nodes of a relation member take the id and tags of the relation
         return [{
-            'type': 'node', 'id': way['id'],
-            'lat':point[0], 'lon':point[1], 'tags': way['tags']
-            } for point in zip(LAT,LON)]
+            'type': 'node', 'id': feature['id'],
+            'lat':point[0], 'lon':point[1], 'tags': feature.get('tags','empty')
+            } for point in way_coords(way)]
 
     node_list = []
     for feature in ovp_response['elements']: 
@@ -72,15 +181,29 @@ def atomize_features(ovp_response):
             node_list.append(feature)
 
         elif feature['type'] == 'way':
-            try:
-                node_list.extend(way_to_nodes(feature))
-            except:
-                continue
+            node_list.extend(way_to_nodes(feature,feature))
 
         else:    # 'relation' element
             for member in feature['members']:
-                try:
-                    node_list.extend(way_to_nodes(member))
-                except:
-                    continue
-    return node_list
\ No newline at end of file
+                if member['type'] == 'way':
+                    node_list.extend(way_to_nodes(member,feature))
+    return node_list
+
+def element_signature(elem):
+    """
+    A short string identifying the 'state' of an Overpass element, used to
+    tell whether an element changed between two runs of the same query.
+    If the response includes metadata (`out meta`), the element version is used;
+    otherwise it is a hash of the geometry and the tags.
+    Args:
+        elem: an element of an Overpass API response
+    Returns: str
+    """
+    if 'sig' in elem: # already computed, e.g. when loaded by storage.load_processed
+        return elem['sig']
+    if 'version' in elem:
+        return f"v{elem['version']}"
+    content = {k: elem.get(k) for k in ('lat','lon','geometry','members','tags')}
+    blob = json.dumps(content,sort_keys = True).encode('utf-8')
+    return hashlib.sha1(blob).hexdigest()
+
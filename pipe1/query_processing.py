@@ -7,8 +7,8 @@ import shapely.geometry as geom
 # from shapely.ops import unary_union
 from shapely.prepared import prep
 
-from .utils import deg2num, num2deg, sample_complement
-from .query_helpers import atomize_features
+from .utils import deg2num, num2deg, deg2pixel, tile_bounds, sample_complement
+from .query_helpers import atomize_features, way_coords
 
 def covering_grid(poly,tile_size):
     """
@@ -117,6 +117,21 @@ def is_basically_closed(coords):
     yRng = max(c[1] for c in coords) - min(c[1] for c in coords)
     return abs(x0-xN) < 0.01*xRng and abs(y0-yN) < 0.01*yRng
 
+def way_is_closed(way_dict,coords):
+    """
+    whether a way forms a ring
+    Args:
+        way_dict: the geoJSON representation of the way
+        coords: its coordinates, as returned by `way_coords`
+    """
+    if 'nodes' in way_dict:
+        # a clipped way (see `build_ql_query`) which lost points is no longer a ring
+        return way_dict['nodes'][0] == way_dict['nodes'][-1] and \
+            len(coords) == len(way_dict['geometry'])
+    if 'role' in way_dict:
+        return way_dict['role'] == 'outer' and is_basically_closed(coords)
+    return False
+
 def process_way(way_dict,**kwargs):
     """
     process an open or closed way, finding a (mutually disjoint) set of tiles
@@ -128,17 +143,12 @@ def process_way(way_dict,**kwargs):
         list of (Shapely.geometry.polygon.Polygon,float) tuples  (tile, overlap)
     """
 
-    coords = [(x['lat'], x['lon']) for x in way_dict['geometry']]
+    coords = way_coords(way_dict)
     
     if len(coords) < 5: # treat it as node instead?
         return []
-    is_closed = False
-    if 'nodes' in way_dict:
-        is_closed = way_dict['nodes'][0] == way_dict['nodes'][-1]
-    elif 'role' in way_dict:
-        is_closed = way_dict['role'] == 'outer' and is_basically_closed(coords)
     
-    if is_closed:
+    if way_is_closed(way_dict,coords):
         poly = geom.Polygon(shell = coords)
     else:
         LS = geom.LineString(coords)
@@ -152,15 +162,148 @@ def process_way(way_dict,**kwargs):
     kwargs['poly'] = poly
     return polygon_tiles(**kwargs)
 
-def process_relation(rel_dict,**kwargs):
+def assemble_rings(ways):
+    """
+    join ways end to end into closed rings, as needed for multipolygon relations,
+    where a ring is often split over several member ways.
+    Each way is used at most once, so this takes linear time in the number of ways.
+    Args:
+        ways: list of coordinate lists
+    Returns: tuple (rings,loose) of the closed rings and the ways which could not be closed
+    """
+    # index of ways by (rounded) endpoint
+    def key(c):
+        return (round(c[0],7),round(c[1],7))
+    ends = {}
+    for i,w in enumerate(ways):
+        for c in (w[0],w[-1]):
+            ends.setdefault(key(c),[]).append(i)
+    used = [False] * len(ways)
+    rings, loose = [], []
+    for i,w in enumerate(ways):
+        if used[i]:
+            continue
+        used[i] = True
+        ring, flipped = list(w), False
+        while key(ring[0]) != key(ring[-1]):
+            nxt = [j for j in ends[key(ring[-1])] if not used[j]]
+            if not nxt:
+                if flipped:
+                    break
+                # dead end: carry on from the other end of the chain
+                ring, flipped = ring[::-1], True
+                continue
+            j = nxt[0]
+            used[j] = True
+            wj = ways[j]
+            # append in the direction that continues the ring
+            ring.extend(wj[1:] if key(wj[0]) == key(ring[-1]) else wj[-2::-1])
+        if len(ring) > 3 and (key(ring[0]) == key(ring[-1]) or is_basically_closed(ring)):
+            rings.append(ring)
+        else:
+            loose.append(ring)
+    return rings, loose
+
+def relation_rings(rel_dict):
+    """
+    assemble the member ways of a relation into rings
+    Args:
+        rel_dict: the geoJSON representation of the relation
+    Returns:
+        tuple (outer,inner,loose): lists of coordinate lists; `outer` and `inner`
+        are closed rings (members without a role count as outer), `loose` are the
+        ways which don't form rings, e.g. the members of a route relation
+    """
+    by_role = {'outer': [], 'inner': []}
+    for mem in rel_dict['members']:
+        coords = way_coords(mem) if mem['type'] == 'way' else []
+        if len(coords) > 1:
+            by_role['inner' if mem.get('role') == 'inner' else 'outer'].append(coords)
+    outer, loose = assemble_rings(by_role['outer'])
+    inner, loose_in = assemble_rings(by_role['inner'])
+    return outer, inner, loose + loose_in
+
+def relation_polygon(rel_dict):
+    """
+    build a single (Multi)Polygon with holes from the rings of a (multipolygon) relation
+    Args:
+        rel_dict: the geoJSON representation of the relation
+    Returns:
+        tuple (poly,loose): a shapely Polygon or MultiPolygon (None if the relation has
+        no closed rings) and the member ways which don't form rings
+    """
+    outer, inner, loose = relation_rings(rel_dict)
+    if not outer:
+        return None, loose
+    shells = sorted((geom.Polygon(r) for r in outer),key = lambda p: p.area)
+    holes = [[] for _ in shells]
+    for r in inner:
+        pt = geom.Polygon(r).representative_point()
+        # the smallest outer ring containing the hole
+        for k,sh in enumerate(shells):
+            if sh.contains(pt):
+                holes[k].append(r)
+                break
+    polys = [geom.Polygon(sh.exterior.coords,hh) for sh,hh in zip(shells,holes)]
+    poly = polys[0] if len(polys) == 1 else geom.MultiPolygon(polys)
+    if not poly.is_valid: # e.g. touching or nested outer rings
+        poly = poly.buffer(0)
+    return poly, loose
+
+def process_relation(rel_dict,node_size = 0.01,**kwargs):
+    """
+    process a relation: its member ways are assembled into one (Multi)Polygon,
+    with the inner members as holes, which is then tiled once; member ways which
+    don't form a ring (e.g. in route relations) and member nodes are processed separately
+    Args:
+        rel_dict: the geoJSON representation of the relation
+        node_size: tile size for member nodes, as in `process_node`
+        **kwargs: forwarded to polygon_tiles (via process_way for loose member ways)
+    Returns:
+        list of (Shapely.geometry.polygon.Polygon,float) tuples  (tile, overlap)
+    """
+    poly, loose = relation_polygon(rel_dict)
     res = []
+    if poly is not None and not poly.is_empty:
+        pkw = dict(kwargs)
+        pkw.setdefault('n_tile',25)
+        pkw.setdefault('min_ovp',0.05)
+        pkw.setdefault('max_ovp',1)
+        pkw.setdefault('tile_size',0.2 * approx_dim(poly))
+        res.extend(polygon_tiles(poly,**pkw))
+    for coords in loose:
+        res.extend(process_way({'geometry': [{'lat': c[0],'lon': c[1]} for c in coords]},**kwargs))
     for mem in rel_dict['members']:
-        if mem['type'] == 'way':
-            res.extend(process_way(mem,**kwargs))
-        else: # node
-            res.append(process_node(mem))
+        if mem['type'] == 'node' and 'lat' in mem:
+            res.append(process_node(mem,node_size))
     return res
 
+def node_tiles(nodes,zoom : int):
+    """
+    vectorized version of `process_node` + `find_tile_coords` for many nodes at once:
+    each node is mapped straight to the map tile containing it at zoom `zoom`,
+    without building any Shapely geometry (see `tile_geometries` for that)
+    Args:
+        nodes: list of node elements (dicts with 'lat' and 'lon')
+        zoom: level of zoom between 1 and 19
+    Returns:
+        a pandas.DataFrame with the columns in `TILE_COLUMNS`, one row per node;
+        the bounds are those of the map tile
+    """
+    lat = np.fromiter((n['lat'] for n in nodes),dtype = float,count = len(nodes))
+    lon = np.fromiter((n['lon'] for n in nodes),dtype = float,count = len(nodes))
+    px, py = deg2pixel(lat,lon,zoom,tile_px = 1)
+    top = 2 ** zoom - 1
+    xx = np.clip(np.floor(px),0,top).astype(np.int64)
+    yy = np.clip(np.floor(py),0,top).astype(np.int64)
+    min_lat, min_lon, max_lat, max_lon = tile_bounds(xx,yy,zoom)
+    return pd.DataFrame({
+        'type': 'node',
+        'id': np.fromiter((n['id'] for n in nodes),dtype = np.int64,count = len(nodes)),
+        'z': zoom,'x': xx,'y': yy,'overlap': 1.0,
+        'min_lat': min_lat,'min_lon': min_lon,'max_lat': max_lat,'max_lon': max_lon
+    },columns = TILE_COLUMNS)
+
 def find_tile_coords(tile,zoom : int):
     """
     given a tile identified as 'of interest',
@@ -176,21 +319,37 @@ def find_tile_coords(tile,zoom : int):
     center = list(tile.centroid.coords)[0]
     return (*deg2num(center[0],center[1],zoom),zoom)
 
+def tile_geometries(tiles):
+    """
+    rebuild the tile boxes of a tile table as Shapely Polygons
+    (only needed for inspection; the table itself just stores the bounds)
+    Args:
+        tiles: the 'tiles' table of a processed query
+    Returns: list of shapely.geometry.Polygon, one per row of `tiles`
+    """
+    return [geom.box(*bb) for bb in zip(
+        tiles['min_lat'],tiles['min_lon'],tiles['max_lat'],tiles['max_lon']
+    )]
+
 def calc_map_locations(processed_query):
     """
     given a processed query (return value of process_query),
     and level of zooming, find the corresponding map coordinates to fetch the tiles
     Args:
-        processed_query: the output of `process_query`
+        processed_query: the output of `process_query` (or `storage.load_processed`)
     Returns:
         a pandas.DataFrame with columns 'x', 'y', and 'z'
     """
-    res = set()
-    z = processed_query['zoom']
-    for elem in processed_query['elements']:
-        if not len(elem['tiles']): continue
-        res.update(find_tile_coords(tile[0],z) for tile in elem['tiles'])
-    return pd.DataFrame.from_records(list(res),columns = ['x','y','z'])
+    return processed_query['tiles'][['x','y','z']] \
+        .drop_duplicates() \
+        .reset_index(drop = True)
+
+# columns of the tile table created by process_query: the element each tile
+# belongs to, its map coordinates, the overlap and the bounds of the tile box
+TILE_COLUMNS = [
+    'type','id','z','x','y','overlap',
+    'min_lat','min_lon','max_lat','max_lon'
+]
 
 # this should become a method?
 def process_query(
@@ -198,8 +357,9 @@ def process_query(
     min_ovp = 0, max_ovp = 1):
     """
     an Overpass API query returns a geoJSON-like response. This function loops over the response
-    list and finds tiles which overlap with the query response. It appends the tiles
-    to the query response, returning an augmented geoJSON object.
+    list and finds tiles which overlap with the query response. The tiles are collected
+    in a flat table (one row per element/tile pair) rather than attached to the elements,
+    so the input is not modified and the result can be saved with `storage.save_processed`.
     Args:
         ovp_query: result of an Overpass API query
         zoom: level of zoooming in [1,19]
@@ -208,118 +368,36 @@ def process_query(
         max_ovp: maximum intersection between tile and polygon to be included in the result;
         set to anything < 1 if tiles on the interior of a polygon are not wanted
     Returns:
-        a geoJSON-like object whose elements have an added 'tiles' property
+        a shallow copy of `ovp_query` with added 'zoom', 'total_tiles' and 'tiles' entries;
+        'tiles' is a pandas.DataFrame with the columns in `TILE_COLUMNS`
     """
-    if len(ovp_query['elements']) is 0:
+    if len(ovp_query['elements']) == 0:
         raise ValueError("The query is empty - cannot continue!")
-    for i,elem in enumerate(ovp_query['elements']):
+    if int(zoom) != zoom or zoom < 1 or zoom > 19:
+        raise ValueError(f"zoom should be an integer in [1,19]; got {zoom}")
+    records, nodes = [], []
+    for elem in ovp_query['elements']:
         etype = elem['type']
         if etype == 'node':
-            tiles = [process_node(elem,0.01)] # need to coordinate the size with zooming!
+            nodes.append(elem) # all handled at once below
+            continue
         elif etype == 'way':
             tiles = process_way(elem,n_tile = max_tiles_per_entity,
                 min_ovp = min_ovp,max_ovp = max_ovp)
         elif etype == 'relation':
-            tiles = process_relation(elem,min_ovp = 0.01)
+            tiles = process_relation(elem,n_tile = max_tiles_per_entity,min_ovp = 0.01)
         else:
             raise ValueError(f"Should not occur! type is {etype}")
-        elem['tiles'] = tiles
-    ovp_query['zoom'] = zoom # track @ which zoom it was processed
-    ntiles = sum(len(e['tiles']) for e in ovp_query['elements'])
-    ovp_query['total_tiles'] = ntiles
-    print(f"Identified {ntiles} positive tiles at zoom {zoom}.")
-    # this is obviously duplicative and should be reconsdiered
-    # but for ease of inspection let's also add all the tiles
-    # as a flat list, esp. to check min_ovp/max_ovp
-    ovp_query['tiles'] = sum((e['tiles'] for e in ovp_query['elements']),[])
-    return ovp_query
-
-def basic_tileset(geo_dict, zooms, buffer = 0,n_neg = None):
-    """
-    This function creates outputs (x,y,z) tile coordinate files which can be
-    fed into download_tiles.sh or the save_tiles function to get tiles from the OSM server.
-
-    Args:
-        geo_dict: an Overpass API query response
-        zooms: zoom levels of tiles to be extracted 
-        buffer: if nonzero, any negative tile will be at least this far away from the postive
-        set, measured by L2 distance, ensuring more separation between classes if desired.
-        n_neg: if provided, will fetch this many negative tiles rather than the 
-    
-    Returns: dict with two pandas.DataFrame: 'positive' and 'negative'
-    """
-    if len(geo_dict['elements']) is 0:
-        raise ValueError("The query is empty - cannot continue!")
-    if type(zooms) is int:
-        zooms = [zooms]
-    if any(z < 2 or z > 19 for z in zooms):
-        raise ValueError("all zoom levels must be between 2 and 19")
-    
-    nodes = atomize_features(geo_dict)
-    points_list = [(node['lat'],node['lon']) for node in nodes]
-    pos_DFs, neg_DFs = [], []
-
-    for zoom in zooms:
-
-        zxy = [(zoom,*deg2num(x,y,zoom)) for x,y in points_list]
-        pos_df = pd.DataFrame.from_records(zxy,columns = ['z','x','y']).drop_duplicates()
-        num_neg = pos_df.shape[0] if n_neg is None else int(n_neg)
-        neg_x, neg_y = sample_complement(pos_df['x'],pos_df['y'],num_neg,buffer)
-        neg_df = pd.DataFrame({'z': zoom,'x': neg_x,'y': neg_y}).sort_values(by = ['z','x','y'])
-        pos_DFs.append(pos_df)
-        neg_DFs.append(neg_df)
-    
-    out_pos = pd.concat(pos_DFs,axis = 0)
-    out_neg = pd.concat(neg_DFs,axis = 0)
-    # add back the longitude/latitude coordinates
-    LLpos = [num2deg(x,y,z) for x,y,z in zip(out_pos['x'],out_pos['y'],out_pos['z'])]
-    LLneg = [num2deg(x,y,z) for x,y,z in zip(out_neg['x'],out_neg['y'],out_neg['z'])]
-    out_pos['latitude']  = [e[0] for e in LLpos]
-    out_pos['longitude'] = [e[1] for e in LLpos]
-    out_neg['latitude']  = [e[0] for e in LLneg]
-    out_neg['longitude'] = [e[1] for e in LLneg]
-    common_row = pd.merge(out_pos,out_neg,on = ['z','x','y']).shape[0]
-    if common_row > 0:
-        raise RuntimeError(f"Somehow there are {common_row} common rows!")
-    return {'positive': out_pos, 'negative': out_neg }    
-
-def shapely_tileset(processed_query,min_ovp = 0,max_ovp = 1,
-    n_neg = None,buffer = 0):
-    """
-    Create a DataFrame containing information on all tiles identified
-    as downloadable
-    Args:
-        processed_query: return value of `process_query`
-        min_ovp: float in [0,1]; only keep tiles where intersection between shape and tile box is at least `min_ovp`
-        max_ovp: float in [0,1]; only keep tiles where intersection between shape and tile box is at most `max_ovp`
-        n_neg: int, optional; number of negative tiles to download
-        buffer: int, optional; margin between positive and negative data sets (in # of tiles)
-    Returns:
-        A pandas DataFrame with tile locations and corresponding metadata
-    """
-    file_locs, types, xx, yy, qual, tags = [],[],[],[],[],[]
-    z = processed_query['zoom']
-    for elem in processed_query['elements']:
-        for tile in elem['tiles']:
-            qq = tile[1]
-            if qq >= min_ovp and qq <= max_ovp:
-                x,y,_ = find_tile_coords(tile[0],z)
-                xx.append(x)
-                yy.append(y)
-                qual.append(tile[1])
-                tags.append(json.dumps(elem['tags']))
-                types.append(elem['type'])
-    
-    pos_df = pd.DataFrame({
-        'z': z, 'x' : xx, 'y': yy, 
-        'entity': types,
-        'overlap': qual,'tags': tags,
-        'placename': processed_query['query_info']['placename']
-    }) \
-    .drop_duplicates(subset = ['x','y']) \
-    .sort_values(by = ['x','y'])
-    if n_neg is None: n_neg = pos_df.shape[0]
-    negt = sample_complement(pos_df['x'],pos_df['y'],n_neg,buffer)
-    neg_df = pd.DataFrame({'z': z,'x': negt[0],'y': negt[1]}) \
-        .sort_values(by = ['x','y'])
-    return { 'positive': pos_df, 'negative': neg_df }
+        for tile,ovp in tiles:
+            x,y,_ = find_tile_coords(tile,zoom)
+            records.append((etype,elem['id'],zoom,x,y,ovp,*tile.bounds))
+    tiles = pd.DataFrame.from_records(records,columns = TILE_COLUMNS)
+    if nodes:
+        tiles = pd.concat([node_tiles(nodes,zoom),tiles],axis = 0,ignore_index = True) \
+            if len(records) else node_tiles(nodes,zoom)
+    res = dict(ovp_query)
+    res['zoom'] = zoom # track @ which zoom it was processed
+    res['tiles'] = tiles
+    res['total_tiles'] = tiles.shape[0]
+    print(f"Identified {tiles.shape[0]} positive tiles at zoom {zoom}.")
+    return res
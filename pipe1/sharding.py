@@ -0,0 +1,156 @@
+# splitting tile tables into spatially coherent shards by quadkey range,
+# so downloading and post-processing can be spread over several machines
+
+import os
+import glob
+
+import numpy as np
+import pandas as pd
+
+from .utils import morton_code, save_tsv
+from .downloading import save_tiles
+
+def shard_keys(df,align_zoom,max_zoom):
+    """
+    Sort keys for the rows of a tile table: the quadkey of the enclosing tile at
+    `align_zoom`, and the quadkey of the tile itself scaled to `max_zoom`
+    (so a tile sorts right before its descendants)
+    Args:
+        df: pandas.DataFrame with columns x, y and z
+        align_zoom: int, no larger than any zoom in `df`
+        max_zoom: int, no smaller than any zoom in `df`
+    Returns: tuple of two numpy int64 arrays
+    """
+    xx, yy = df['x'].values.astype(np.int64), df['y'].values.astype(np.int64)
+    zz = df['z'].values.astype(np.int64)
+    up = zz - align_zoom
+    cell = morton_code(xx >> up,yy >> up,align_zoom)
+    fine = morton_code(xx << (max_zoom - zz),yy << (max_zoom - zz),max_zoom)
+    return cell, fine
+
+def plan_shards(dfs,n_shards,align_zoom = None):
+    """
+    Partition tile tables into `n_shards` shards of about equal size, each covering
+    a contiguous range of quadkeys. All tiles inside the same tile at `align_zoom`
+    end up in the same shard, so a tile and its children (which the overview builder
+    composites) stay together, as do tiles which are close on the map.
+    Args:
+        dfs: dict of DataFrames with columns x, y and z (e.g. the output of `basic_tileset`)
+        n_shards: number of shards
+        align_zoom: optional, zoom level of the cells which are never split between shards;
+        defaults to the smallest zoom in `dfs`
+    Returns:
+        dict with the same keys as `dfs`, where each DataFrame has an added `shard` column
+    """
+    if n_shards < 1:
+        raise ValueError(f"n_shards must be positive; got {n_shards}")
+    names = list(dfs.keys())
+    allz = np.concatenate([dfs[k]['z'].values for k in names])
+    if align_zoom is None:
+        align_zoom = int(allz.min())
+    if align_zoom > allz.min():
+        raise ValueError(f"align_zoom {align_zoom} is larger than the smallest zoom {allz.min()}")
+    keys = {k: shard_keys(dfs[k],align_zoom,int(allz.max())) for k in names}
+
+    # balance on the number of tiles per cell, over all the tables together
+    cells, counts = np.unique(np.concatenate([keys[k][0] for k in names]),return_counts = True)
+    cum = np.cumsum(counts)
+    mid = (cum - counts / 2) / cum[-1] # position of each cell's midpoint in [0,1]
+    cell_shard = np.minimum((mid * n_shards).astype(int),n_shards - 1)
+
+    res = {}
+    for k in names:
+        cell, fine = keys[k]
+        order = np.lexsort((fine,cell))
+        shard = cell_shard[np.searchsorted(cells,cell)]
+        res[k] = dfs[k].assign(shard = shard).iloc[order]
+    sizes = np.bincount(np.concatenate([res[k]['shard'].values for k in names]),minlength = n_shards)
+    print(f"{len(cells)} cells at zoom {align_zoom} in {n_shards} shards of {sizes.min()} to {sizes.max()} tiles")
+    return res
+
+def write_shard_manifests(dfs,n_shards,outdir,align_zoom = None):
+    """
+    Plan shards (see `plan_shards`) and write one directory per shard,
+    `shard_000`, `shard_001`, ..., containing one .tsv manifest per table.
+    The manifests start with columns x, y and z so they can also be given
+    to bin/download_tiles.
+    Args:
+        dfs: dict of DataFrames with columns x, y and z
+        n_shards: number of shards
+        outdir: directory in which the shard directories are created
+        align_zoom: optional, as in `plan_shards`
+    Returns: list of the shard directories
+    """
+    planned = plan_shards(dfs,n_shards,align_zoom)
+    dirs = []
+    for i in range(n_shards):
+        sdir = os.path.join(os.path.abspath(os.path.expanduser(outdir)),f"shard_{i:03d}")
+        os.makedirs(sdir,exist_ok = True)
+        for k,df in planned.items():
+            ds = df[df['shard'] == i]
+            cols = ['x','y','z'] + [c for c in ds.columns if c not in ('x','y','z')]
+            save_tsv(ds[cols],os.path.join(sdir,f"{k}.tsv"))
+        dirs.append(sdir)
+    return dirs
+
+def run_shard(shard_dir,output_dirs,**kwargs):
+    """
+    Download the tiles of one shard; this is what each machine runs.
+    Results go to `<table>_done.tsv` and the download journal to
+    `journal.tsv` in the shard directory, where `merge_shards` looks for them.
+    Args:
+        shard_dir: a directory written by `write_shard_manifests`
+        output_dirs: dict mapping table names (e.g. 'positive') to the tile directory
+        **kwargs: forwarded to `save_tiles`
+    """
+    journal = os.path.join(shard_dir,'journal.tsv')
+    for k,odir in output_dirs.items():
+        manifest = pd.read_csv(os.path.join(shard_dir,f"{k}.tsv"),sep = '\t')
+        done = save_tiles(manifest,odir,journal = journal,**kwargs)
+        save_tsv(done,os.path.join(shard_dir,f"{k}_done.tsv"))
+
+def merge_shards(shard_dirs):
+    """
+    Merge the results of `run_shard` over all shards back into one table per
+    manifest, and check them against the manifests
+    Args:
+        shard_dirs: list of shard directories, or the directory containing them
+    Returns:
+        dict with one merged DataFrame per table (e.g. 'positive', 'negative'),
+        plus 'journal' (all download journals), 'missing' (manifest rows without a
+        result) and 'duplicates' (tiles with a result in more than one row)
+    """
+    if isinstance(shard_dirs,str):
+        shard_dirs = sorted(glob.glob(os.path.join(shard_dirs,'shard_*')))
+    key = ['x','y','z']
+    manifests, results, journals = {}, {}, []
+    for sdir in shard_dirs:
+        for f in sorted(glob.glob(os.path.join(sdir,'*.tsv'))):
+            name = os.path.basename(f)[:-4]
+            if name == 'journal':
+                journals.append(pd.read_csv(f,sep = '\t').assign(shard_dir = sdir))
+            elif name.endswith('_done'):
+                results.setdefault(name[:-5],[]).append(pd.read_csv(f,sep = '\t'))
+            else:
+                manifests.setdefault(name,[]).append(pd.read_csv(f,sep = '\t'))
+
+    res, missing, dups = {}, [], []
+    for k,mm in manifests.items():
+        man = pd.concat(mm,axis = 0,ignore_index = True)
+        done = pd.concat(results.get(k,[man.iloc[:0]]),axis = 0,ignore_index = True)
+        dd = done[done.duplicated(subset = key,keep = False)]
+        if dd.shape[0]:
+            dups.append(dd.assign(table = k))
+        done = done.drop_duplicates(subset = key)
+        mi = pd.merge(man[key],done[key],on = key,how = 'left',indicator = True)
+        mi = mi[mi['_merge'] == 'left_only'].drop(columns = '_merge')
+        if mi.shape[0]:
+            missing.append(mi.assign(table = k))
+        res[k] = done.drop(columns = 'shard',errors = 'ignore')
+        print(f"{k}: {done.shape[0]} of {man.shape[0]} tiles, {mi.shape[0]} missing, {dd.shape[0]} duplicate rows")
+    res['journal'] = pd.concat(journals,axis = 0,ignore_index = True) if journals else pd.DataFrame()
+    res['missing'] = pd.concat(missing,axis = 0,ignore_index = True) if missing \
+        else pd.DataFrame(columns = key + ['table'])
+    res['duplicates'] = pd.concat(dups,axis = 0,ignore_index = True) if dups \
+        else pd.DataFrame(columns = key + ['table'])
+    return res
@@ -2,7 +2,8 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.collections import PatchCollection
-from matplotlib.patches import Rectangle
+from matplotlib.patches import Rectangle, Patch
+from matplotlib.colors import ListedColormap
 from matplotlib import cm # color maps
 
 
@@ -10,53 +11,102 @@ from matplotlib import cm # color maps
 # positive vs. negative tiles since they're kinda hard to
 # see against white bg
 
-# first prepare all the data
-# 'class' values are indices into the color palette
-# which can be defined
-def plot_tiles(tiles,zoom = None,tile_size = 5):
-    """
-    Show positions of positive and negative tiles
+# above this many tiles, plot_tiles paints an image instead of drawing patches
+RASTER_THRESHOLD = 20000
+
+def _tile_classes(tiles):
+    # 'class' values are indices into the color palette; the inputs are not modified
+    dp, dn = tiles['positive'], tiles['negative']
+    return pd.DataFrame({
+        'z': np.concatenate([dp['z'].values,dn['z'].values]),
+        'x': np.concatenate([dp['x'].values,dn['x'].values]),
+        'y': np.concatenate([dp['y'].values,dn['y'].values]),
+        'class': np.repeat([0,1],[dp.shape[0],dn.shape[0]])
+    })
 
+def tile_raster(dz,max_px = 2000):
+    """
+    Paint tiles into an image with one pixel per tile, or per `b` x `b` block
+    of tiles if the extent is more than `max_px` tiles wide or high
     Args:
-        tiles: the output of `create_tileset` function (dict with 'positive' and 'negative' dataframes)
-        zoom: int, optional: level of zoom for which tiles are plotted if `tiles` has mutiple zooming levels
+        dz: DataFrame with columns x, y and class (0 for positive, 1 for negative), at a single zoom
+        max_px: maximum width/height of the image
+    Returns:
+        tuple (img,extent,b): the image (0 = no tiles, 1 = positive, 2 = negative,
+        3 = both in the same block), its extent in tile coordinates as used by
+        `imshow`, and the block size
     """
+    xx, yy, cc = dz['x'].values, dz['y'].values, dz['class'].values
+    x0, y0 = xx.min(), yy.min()
+    b = int(max(1,np.ceil(max(np.ptp(xx) + 1,np.ptp(yy) + 1) / max_px)))
+    bx, by = (xx - x0) // b, (yy - y0) // b
+    img = np.zeros((by.max() + 1,bx.max() + 1),dtype = np.uint8)
+    for cls,flag in ((0,1),(1,2)):
+        sel = cc == cls
+        img[by[sel],bx[sel]] |= flag
+    # tile y increases going south, so the first row is the top of the image
+    extent = (x0,x0 + b * img.shape[1],y0 + b * img.shape[0],y0)
+    return img, extent, b
 
-    dp = tiles['positive']
-    dp['class'] = 0
-    dn = tiles['negative']
-    dn['class'] = 1
-
-    dc = pd.concat([dp,dn],axis = 0)
-    if zoom is None: # choose first zoom if user didn't specify
-        zoom = dc['z'].array[0]
-    dz = dc[dc['z'] == zoom] 
+def _draw_raster(ax,dz,max_px):
+    img, extent, b = tile_raster(dz,max_px)
+    colors = cm.Dark2.colors
+    cmap = ListedColormap(['white',colors[0],colors[1],colors[2]])
+    ax.imshow(img,cmap = cmap,vmin = 0,vmax = 3,extent = extent,
+        interpolation = 'nearest',origin = 'upper')
+    if b > 1:
+        ax.set_title(f"{b} x {b} tiles per pixel",fontsize = 'small')
+    return [Patch(color = colors[i],label = lab) for i,lab in enumerate(['positive','negative','both'])]
 
-    # x = np.array([1,4,5,8,10])
-    # y = np.array([0,4,0,2,0])
-    # cc = np.array([0,1,0,1,0])
-    # dz = {'x': x,'y': y,'class': cc}
+def _draw_patches(ax,dz,tile_size):
     adj = 0.5 * tile_size
     rects = [Rectangle((x - adj,y - adj),width = tile_size,height = tile_size,alpha = 0.5) \
         for x,y in zip(dz['x'],dz['y'])]
 
     # create collection of patches for IFU position
     Rekts = PatchCollection(rects,cmap = cm.Dark2)
-    Rekts.set_array(dz['class'])
+    Rekts.set_array(dz['class'].values)
+    # https://matplotlib.org/3.1.1/gallery/statistics/errorbars_and_boxes.html#sphx-glr-gallery-statistics-errorbars-and-boxes-py
+    ax.add_collection(Rekts)
+    ax.axis('scaled')
+    ax.invert_yaxis() # tile y increases going south
 
-    # set aspect ratio according to bounding box:
-    width, height = np.ptp(dz['x']), np.ptp(dz['y'])
-    pw, ph = 9, 9
-    if width > height:
-        ph *= height / width
+def plot_tiles(tiles,zoom = None,tile_size = 5,raster = None,facet = False,max_px = 2000):
+    """
+    Show positions of positive and negative tiles
+
+    Args:
+        tiles: the output of `create_tileset` function (dict with 'positive' and 'negative' dataframes)
+        zoom: int, optional: level of zoom for which tiles are plotted if `tiles` has mutiple zooming levels
+        tile_size: size of the squares drawn for each tile (when not rasterized)
+        raster: whether to paint the tiles into an image (one pixel per tile, or per block
+        of tiles for large extents) rather than drawing a square for each tile;
+        by default, this is done when there are more than `RASTER_THRESHOLD` tiles
+        facet: if True, show each zoom level in its own panel (and ignore `zoom`)
+        max_px: maximum size of the rasterized image, in pixels
+    """
+    dc = _tile_classes(tiles)
+    if facet:
+        zooms = sorted(dc['z'].unique())
     else:
-        pw *= width / height
+        if zoom is None: # choose first zoom if user didn't specify
+            zoom = dc['z'].values[0]
+        zooms = [zoom]
+    if raster is None:
+        raster = dc[dc['z'].isin(zooms)].shape[0] > RASTER_THRESHOLD
 
-    fig = plt.figure(figsize = (pw,ph))
-    ax = plt.axes([0.1,0.1,0.7,0.7])
-    plt.xlabel('x (Longitude)')
-    plt.ylabel('y (Latitude)')
-    # https://matplotlib.org/3.1.1/gallery/statistics/errorbars_and_boxes.html#sphx-glr-gallery-statistics-errorbars-and-boxes-py
-    ax.add_collection(Rekts)
-    plt.axis('scaled')
+    fig, axes = plt.subplots(1,len(zooms),figsize = (7 * len(zooms),7),squeeze = False)
+    for ax,z in zip(axes[0],zooms):
+        dz = dc[dc['z'] == z]
+        if raster:
+            handles = _draw_raster(ax,dz,max_px)
+        else:
+            _draw_patches(ax,dz,tile_size)
+            handles = None
+        ax.set_xlabel('x (Longitude)')
+        ax.set_ylabel('y (Latitude)')
+        if len(zooms) > 1:
+            ax.set_title(f"zoom {z}" + (f"\n{ax.get_title()}" if ax.get_title() else ''))
+    if raster:
+        fig.legend(handles = handles,loc = 'upper right')
     plt.show()
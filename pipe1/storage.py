@@ -0,0 +1,166 @@
+# saving and loading processed queries and tile tables in a compact
+# columnar format so tiles don't have to be recomputed on every run
+
+import os
+import json
+
+import numpy as np
+
+from .query_helpers import element_signature
+
+# key under which the query/element information is stored
+# in the schema metadata of the saved table
+META_KEY = b'pipe1'
+
+def _arrow():
+    # pyarrow is only needed here, so we don't make it a hard dependency
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        import pyarrow.feather as feather
+    except ImportError as e:
+        raise ImportError("saving/loading tile tables requires pyarrow: pip install pyarrow") from e
+    return pa, pq, feather
+
+def _file_format(path,fmt = None):
+    if fmt is None:
+        fmt = 'feather' if str(path).endswith(('.feather','.arrow')) else 'parquet'
+    if fmt not in ('parquet','feather'):
+        raise ValueError(f"format must be 'parquet' or 'feather'; got {fmt}")
+    return fmt
+
+def elements_path(path):
+    """ name of the file holding the element table that goes with a processed query saved at `path` """
+    base, ext = os.path.splitext(str(path))
+    return base + '.elements' + (ext or '.parquet')
+
+def save_processed(processed_query,path,fmt = None):
+    """
+    Save the tile table of a processed query, along with the information needed
+    to build tile sets from it later (zoom, query info, element tags).
+    Element geometries are not stored; the tile boxes are kept as their bounds.
+    The element types, ids, tags and signatures go in a second table next to it
+    (see `elements_path`), with the tags dictionary encoded.
+    Args:
+        processed_query: return value of `process_query`
+        path: file name; ending in .feather or .arrow means Feather, anything else is Parquet
+        fmt: optional, 'parquet' or 'feather' to override the choice based on `path`
+    """
+    pa, pq, feather = _arrow()
+    fmt = _file_format(path,fmt)
+    qi = processed_query.get('query_info') or {}
+    meta = {
+        'zoom': processed_query['zoom'],
+        'query_info': {
+            k: qi.get(k) for k in ('query','placename','geolocation','bounds','types','response_bytes')
+        }
+    }
+    table = pa.Table.from_pandas(processed_query['tiles'],preserve_index = False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        META_KEY: json.dumps(meta).encode('utf-8')
+    })
+    elems = processed_query['elements']
+    etable = pa.table({
+        'type': pa.array([e['type'] for e in elems],pa.string()).dictionary_encode(),
+        'id': pa.array([e['id'] for e in elems],pa.int64()),
+        # many elements share the same tags (e.g. military=bunker)
+        'tags': pa.array([json.dumps(e.get('tags',{}),sort_keys = True) for e in elems],
+            pa.string()).dictionary_encode(),
+        'sig': pa.array([element_signature(e) for e in elems],pa.string())
+    })
+    for tab,fpath in ((table,path),(etable,elements_path(path))):
+        if fmt == 'feather':
+            # uncompressed so that it can be memory mapped when reading
+            feather.write_feather(tab,fpath,compression = 'uncompressed')
+        else:
+            pq.write_table(tab,fpath)
+
+def _read_table(path,fmt,memory_map):
+    _, pq, feather = _arrow()
+    if fmt == 'feather':
+        return feather.read_table(path,memory_map = memory_map)
+    return pq.read_table(path,memory_map = memory_map)
+
+def load_processed(path,fmt = None,memory_map = True):
+    """
+    Load a tile table saved by `save_processed`. The result can be used in place
+    of the return value of `process_query` by `shapely_tileset` and `calc_map_locations`.
+    Args:
+        path: file written by `save_processed`
+        fmt: optional, 'parquet' or 'feather' to override the choice based on `path`
+        memory_map: whether to memory map the file rather than reading it into memory
+    Returns:
+        dict with 'zoom', 'query_info', 'elements', 'tiles' and 'total_tiles' entries;
+        the elements only have 'type', 'id', 'tags' and 'sig' (see `element_signature`)
+    """
+    fmt = _file_format(path,fmt)
+    table = _read_table(path,fmt,memory_map)
+    meta = json.loads(table.schema.metadata[META_KEY])
+    tiles = table.to_pandas()
+    edf = _read_table(elements_path(path),fmt,memory_map).to_pandas()
+    # each distinct tag set is only parsed once
+    tags = edf['tags'].astype('category')
+    parsed = [json.loads(c) for c in tags.cat.categories]
+    elements = [
+        {'type': t, 'id': int(i), 'tags': parsed[c], 'sig': sig}
+        for t,i,c,sig in zip(edf['type'].astype(str),edf['id'],tags.cat.codes,edf['sig'])
+    ]
+    return {
+        'zoom': meta['zoom'],
+        'query_info': meta['query_info'],
+        'elements': elements,
+        'tiles': tiles,
+        'total_tiles': tiles.shape[0]
+    }
+
+# compact dtypes for the positive/negative tables from `basic_tileset`/`shapely_tileset`;
+# the string columns repeat a handful of values so they are dictionary encoded
+TILESET_DTYPES = {'z': 'int8','x': 'int32','y': 'int32','overlap': 'float32'}
+TILESET_CATEGORIES = ('tags','placename','entity')
+
+def save_tileset(df,path):
+    """
+    Save a positive or negative tile table as Parquet, with compact dtypes and
+    one row group per zoom level so that reading a subset of zooms skips the rest.
+    Args:
+        df: pandas.DataFrame with (at least) columns z, x and y
+        path: name of the Parquet file
+    """
+    pa, pq, _ = _arrow()
+    if any(e not in df.columns for e in ('z','x','y')):
+        raise ValueError("df must have columns x, y, and z")
+    df = df.astype({k: v for k,v in TILESET_DTYPES.items() if k in df.columns})
+    for col in TILESET_CATEGORIES:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    df = df.sort_values(by = ['z','x','y'],kind = 'stable')
+    table = pa.Table.from_pandas(df,preserve_index = False)
+    zz = df['z'].values
+    # rows are sorted by zoom, so each zoom is a contiguous slice of the table
+    starts = [0] + list(np.flatnonzero(np.diff(zz)) + 1) + [len(zz)]
+    with pq.ParquetWriter(path,table.schema) as writer:
+        for start,end in zip(starts,starts[1:]):
+            writer.write_table(table.slice(start,end - start))
+
+def load_tileset(path,zooms = None,filters = None,columns = None):
+    """
+    Load a tile table saved by `save_tileset`. Conditions on zoom (and any other
+    `filters`) are pushed down to the Parquet reader, which skips row groups that
+    can't match.
+    Args:
+        path: Parquet file written by `save_tileset`
+        zooms: optional, int or list of zoom levels to read
+        filters: optional, list of (column,op,value) tuples in the pyarrow format,
+        e.g. [('overlap','>=',0.5)]
+        columns: optional, list of columns to read
+    Returns: a pandas.DataFrame
+    """
+    _, pq, _ = _arrow()
+    filters = list(filters or [])
+    if zooms is not None:
+        filters.append(('z','in',[int(z) for z in np.atleast_1d(zooms)]))
+    table = pq.read_table(
+        path,columns = columns,filters = filters or None,memory_map = True
+    )
+    return table.to_pandas()
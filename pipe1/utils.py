@@ -15,6 +15,50 @@ def num2deg(xtile, ytile, zoom):
     lat_deg = math.degrees(lat_rad)
     return lat_deg, lon_deg
 
+def deg2pixel(lat_deg,lon_deg,zoom,tile_px = 256):
+    """
+    vectorized version of `deg2num` which keeps the fractional part, scaled to pixels:
+    returns the global pixel coordinates (px,py) at zoom level `zoom`, so that the
+    tile is (px // tile_px, py // tile_px) and the pixel within it is the remainder
+    """
+    lat_rad = np.radians(np.asarray(lat_deg,dtype = float))
+    n = tile_px * 2.0 ** zoom
+    px = (n / 360) * (np.asarray(lon_deg,dtype = float) + 180)
+    py = (n / 2) * (1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi)
+    return px, py
+
+def tile_bounds(xx,yy,zz):
+    """
+    vectorized tile bounds
+    Args:
+        xx,yy,zz: arrays of tile coordinates
+    Returns: tuple of arrays (min_lat,min_lon,max_lat,max_lon)
+    """
+    xx, yy = np.asarray(xx,dtype = float), np.asarray(yy,dtype = float)
+    n = 2.0 ** np.asarray(zz,dtype = float)
+    def lat(y):
+        return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    return lat(yy + 1), 360 * xx / n - 180, lat(yy), 360 * (xx + 1) / n - 180
+
+def morton_code(xx,yy,zoom):
+    """
+    Interleave the bits of tile coordinates (the integer form of a quadkey),
+    so that sorting by the code keeps nearby tiles together
+    Args:
+        xx, yy: integers or numpy arrays of tile coordinates
+        zoom: int, the number of bits to interleave
+    Returns: numpy int64 (array)
+    """
+    xx, yy = np.asarray(xx,dtype = np.int64), np.asarray(yy,dtype = np.int64)
+    code = np.zeros(np.broadcast(xx,yy).shape,dtype = np.int64)
+    for b in range(zoom):
+        code |= ((xx >> b) & 1) << (2*b) | ((yy >> b) & 1) << (2*b + 1)
+    return code
+
+def quadkey(x,y,z):
+    """ the quadkey string of a tile, as used by Bing maps """
+    return ''.join(str(((x >> b) & 1) | ((y >> b) & 1) << 1) for b in range(z-1,-1,-1))
+
 def sample_complement(xx,yy,n,buffer = 0):
     """ 
     Take a sample from the bounding box of the elements in xx and yy.
@@ -74,6 +118,104 @@ def sample_complement(xx,yy,n,buffer = 0):
     neg_xy = list(neg_xy)[:n_neg]
     return [e[0] for e in neg_xy], [e[1] for e in neg_xy]
 
+def sample_pyramid(xx,yy,zoom,n,buffer = 0,region = None,levels = 6,margin = 1):
+    """
+    Coarse-to-fine alternative to `sample_complement`, whose cost depends on the
+    number of positive and sampled tiles rather than on the size of their bounding box.
+    Positives are counted in the enclosing tiles at each of `levels` coarser zooms
+    (an occupancy pyramid). Candidate cells at the coarsest level are those within
+    `margin` cells of a positive one; a cell is picked with probability proportional
+    to its number of free tiles and refined one zoom level at a time, choosing among
+    the children by their number of free tiles, so the result is never a positive tile.
+    Args:
+        xx, yy: iterables of tile coordinates of the positive tiles, at zoom `zoom`
+        zoom: int, zoom level of the tiles
+        n: number of tiles to sample
+        buffer: int; if positive, each element in the sample must be at least this far away
+        from a 'positive' element
+        region: optional, a shapely geometry with (latitude,longitude) coordinates
+        (as in `process_query`); only tiles intersecting it are sampled. For instance,
+        `shapely.geometry.box(*query['query_info']['bounds'])` for the query area.
+        levels: number of zoom levels between the candidate cells and `zoom`
+        margin: how many cells (at the coarsest level) away from positives to look
+    Returns:
+        tuple newx,newy of lists of ints
+    """
+    xx, yy = np.asarray(xx,dtype = np.int64), np.asarray(yy,dtype = np.int64)
+    if len(xx) == 0:
+        raise ValueError("sample_pyramid: empty input!")
+    if len(yy) != len(xx):
+        raise ValueError("sample_pyramid: lengths of xx and yy must match!")
+    d = min(levels,zoom)
+    zc = zoom - d
+    # occupancy pyramid: counts[l] maps cells at zoom zc+l to their number of positives
+    pos = np.unique(np.stack([xx,yy],axis = 1),axis = 0)
+    counts = []
+    for l in range(d + 1):
+        cells, cnt = np.unique(pos >> (d - l),axis = 0,return_counts = True)
+        counts.append({(int(cx),int(cy)): int(c) for (cx,cy),c in zip(cells,cnt)})
+    # candidate coarse cells: the occupied ones and their neighbours
+    margin = max(margin,int(np.ceil(buffer / 2 ** d)))
+    offs = np.array([(i,j) for i in range(-margin,margin+1) for j in range(-margin,margin+1)])
+    coarse = np.array(list(counts[0].keys()))
+    cand = np.unique((coarse[:,None,:] + offs[None,:,:]).reshape(-1,2),axis = 0)
+    cand = cand[np.all((cand >= 0) & (cand < 2 ** zc),axis = 1)]
+
+    in_region = lambda cx,cy,z: True
+    if region is not None:
+        from shapely.geometry import box
+        from shapely.prepared import prep
+        preg, seen = prep(region), {}
+        def in_region(cx,cy,z):
+            if (cx,cy,z) not in seen:
+                lat0, lon0 = num2deg(cx,cy + 1,z)
+                lat1, lon1 = num2deg(cx + 1,cy,z)
+                seen[(cx,cy,z)] = preg.intersects(box(lat0,lon0,lat1,lon1))
+            return seen[(cx,cy,z)]
+        cand = np.array([c for c in cand if in_region(int(c[0]),int(c[1]),zc)]).reshape(-1,2)
+    if len(cand) == 0:
+        raise ValueError("sample_pyramid: no candidate cells (is the region disjoint from the positives?)")
+
+    free = np.array([4 ** d - counts[0].get((int(cx),int(cy)),0) for cx,cy in cand],dtype = float)
+    print(f"{pos.shape[0]} positive tiles; {len(cand)} candidate cells at zoom {zc}")
+    n_neg = int(min(n,free.sum()))
+    prob = free / free.sum()
+
+    # positives bucketed on a grid of the buffer size, for the distance check
+    bsize = max(1,int(np.ceil(buffer)))
+    buckets = {}
+    for x,y in pos:
+        buckets.setdefault((x // bsize,y // bsize),[]).append((x,y))
+    def far_enough(x,y):
+        bx, by = x // bsize, y // bsize
+        near = [p for i in (-1,0,1) for j in (-1,0,1) for p in buckets.get((bx+i,by+j),[])]
+        return all((x - px)**2 + (y - py)**2 > buffer**2 for px,py in near)
+
+    rng = np.random.default_rng()
+    neg_xy = set()
+    tries, max_tries = 0, 20 * n_neg + 100
+    while len(neg_xy) < n_neg and tries < max_tries:
+        batch = rng.choice(len(cand),size = n_neg - len(neg_xy),p = prob)
+        for k in batch:
+            tries += 1
+            cx, cy = int(cand[k][0]), int(cand[k][1])
+            for l in range(1,d + 1):
+                kids = [(2*cx + i,2*cy + j) for j in (0,1) for i in (0,1)]
+                w = np.array([
+                    (4 ** (d - l) - counts[l].get(c,0)) * in_region(c[0],c[1],zc + l)
+                    for c in kids
+                ],dtype = float)
+                if w.sum() == 0:
+                    break
+                cx, cy = kids[rng.choice(4,p = w / w.sum())]
+            else: # reached the tile level
+                if buffer < 1 or far_enough(cx,cy):
+                    neg_xy.add((cx,cy))
+    if len(neg_xy) < n_neg:
+        print(f"sample_pyramid: only found {len(neg_xy)} of {n_neg} tiles")
+    neg_xy = list(neg_xy)
+    return [e[0] for e in neg_xy], [e[1] for e in neg_xy]
+
 # defining the size of tiles (in terms of latitude/longitude)
 # for a given zoom level and (lat,lon)
 # longitude is easy; # tiles is simply 2^z so tile width is 2^-z
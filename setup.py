@@ -18,5 +18,9 @@ setup(
         'numpy >= 1.17','pandas >= 0.25','shapely >= 1.6',
         'osmxtract >= 0.0.1','pillow >= 6.2','matplotlib ~= 3.1.2',
         'wheel ~= 0.33'
-    ]
+    ],
+    extras_require = {
+        # saving/loading tile tables (pipe1.storage)
+        'arrow': ['pyarrow >= 1.0']
+    }
 )
\ No newline at end of file